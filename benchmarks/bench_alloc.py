@@ -0,0 +1,41 @@
+"""Building field updates with and without the Datagram buffer pool.
+
+With the pool off every Datagram mallocs its buffer and grows it by realloc; with it on, buffers of freed
+datagrams sized from the field's size hint are handed to the next message.
+"""
+import os
+import timeit
+
+from dc import parser
+from dc.util import Datagram, get_buffer_pool, set_buffer_pool
+
+TESTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests')
+FILES = [os.path.join(TESTS, 'otp.dc'), os.path.join(TESTS, 'toon.dc')]
+
+
+def timed(func, number=100000):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def main():
+    dcfile = parser.parse_dc_files(FILES, backend='fast')
+    dclass = dcfile.namespace['DistributedToon']
+    cases = [
+        ('empty Datagram', lambda: Datagram()),
+        ('Datagram(reserve=1000)', lambda: Datagram(reserve=1000)),
+        ('setName update', lambda: dclass.ai_format_update('setName', 1000, 1000, 4000, ('Flippy',))),
+        ('setPos update', lambda: dclass.ai_format_update('setPos', 1000, 1000, 4000, (1.0, 2.0, 3.0))),
+    ]
+
+    _, limit, max_size = get_buffer_pool()
+    print(f'{"message":<24} {"no pool":>10} {"pool":>10}')
+    for name, func in cases:
+        set_buffer_pool(0)
+        unpooled = timed(func)
+        set_buffer_pool(limit, max_size)
+        pooled = timed(func)
+        print(f'{name:<24} {unpooled * 1e9:7.1f} ns {pooled * 1e9:7.1f} ns')
+
+
+if __name__ == '__main__':
+    main()
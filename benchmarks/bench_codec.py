@@ -0,0 +1,90 @@
+"""Field packing and unpacking throughput on typical toontown updates.
+
+Compares packing each parameter through its own pack_value/unpack_value with the compiled field codecs,
+which run in C through NativeCodec where the parameter types allow it, and then a long numeric array packed
+from and unpacked to a list or a NumPy array. The per-parameter path is the current one, which packs and
+unpacks numeric arrays in bulk, not the code the codecs originally replaced.
+"""
+import os
+import timeit
+
+import numpy as np
+
+from dc import parser
+from dc.util import Datagram
+
+TESTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests')
+FILES = [os.path.join(TESTS, 'otp.dc'), os.path.join(TESTS, 'toon.dc')]
+
+CASES = [
+    ('DistributedSmoothNode', 'setSmPosHprL', (7, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7)),
+    ('DistributedSmoothNode', 'setComponentX', (1.5,)),
+    ('DistributedToon', 'setName', ('Flippy',)),
+    ('DistributedToon', 'setDNAString', (bytes(range(30)),)),
+    ('DistributedToon', 'setMaxHp', (137,)),
+    ('DistributedToon', 'setExperience', (bytes(14),)),
+    ('DistributedToon', 'setTrackAccess', ([1, 1, 1, 0, 1, 1, 0],)),
+]
+
+
+def parameters(field):
+    if hasattr(field, 'subfields'):
+        return [p for subfield in field.subfields for p in subfield.parameters]
+    return field.parameters
+
+
+def parameter_pack(field, args):
+    dg = Datagram()
+    for parameter, arg in zip(parameters(field), args):
+        parameter.pack_value(dg, arg)
+    return dg
+
+
+def parameter_unpack(field, dg):
+    dgi = dg.iterator()
+    return tuple(parameter.unpack_value(dgi) for parameter in parameters(field))
+
+
+def new_pack(field, args):
+    dg = Datagram()
+    field.pack_value(dg, args)
+    return dg
+
+
+def timed(func, number=20000):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def main():
+    dcfile = parser.parse_dc_files(FILES, backend='fast')
+    dcfile.compile_codecs()
+
+    print(f'{"field":<16} {"param pack":>11} {"codec pack":>11} {"param unpack":>13} {"codec unpack":>13}')
+    for class_name, field_name, args in CASES:
+        field = dcfile.namespace[class_name][field_name]
+        dg = new_pack(field, args)
+        assert dg.bytes() == parameter_pack(field, args).bytes()
+
+        times = (timed(lambda: parameter_pack(field, args)), timed(lambda: new_pack(field, args)),
+                 timed(lambda: parameter_unpack(field, dg)), timed(lambda: field.unpack_value(dg.iterator())))
+        print(f'{field_name:<16} ' + ' '.join(f'{t * 1e6:8.2f} us' for t in times))
+
+    # A long uint32array, passed as a list and as an ndarray.
+    field = dcfile.namespace['DistributedToon']['setZonesVisited']
+    zones = list(range(5000))
+    array = np.arange(5000, dtype=np.uint32)
+    dg = new_pack(field, (zones,))
+    assert dg.bytes() == new_pack(field, (array,)).bytes()
+
+    list_times = timed(lambda: new_pack(field, (zones,)), 2000), timed(lambda: field.unpack_value(dg.iterator()), 2000)
+    field.compile(numpy_arrays=True)
+    numpy_times = timed(lambda: new_pack(field, (array,)), 2000), timed(lambda: field.unpack_value(dg.iterator()), 2000)
+
+    print()
+    print(f'{"5000 zones":<16} {"pack":>10} {"unpack":>11}')
+    for name, times in (('list', list_times), ('ndarray', numpy_times)):
+        print(f'{name:<16} ' + ' '.join(f'{t * 1e6:8.2f} us' for t in times))
+
+
+if __name__ == '__main__':
+    main()
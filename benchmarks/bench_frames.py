@@ -0,0 +1,87 @@
+"""Framing throughput for a message director stream of small datagrams.
+
+Compares the usual hand-written loop, which slices bytes out of a bytearray and copies each frame into a
+Datagram, with FrameReader, which yields iterators reading the frames in place, and times FrameWriter batching.
+"""
+import time
+
+from dc.util import Datagram, FrameReader, FrameWriter
+
+NUM_FRAMES = 100000
+CHUNK_SIZE = 4096
+
+
+def make_datagrams():
+    datagrams = []
+    for n in range(NUM_FRAMES):
+        dg = Datagram()
+        dg.add_server_header([1000 + n % 10], 4000, 2004)
+        dg.add_uint32(n)
+        datagrams.append(dg)
+
+    return datagrams
+
+
+def make_stream(datagrams):
+    writer = FrameWriter()
+    writer.add_datagrams(datagrams)
+    data = writer.take().bytes()
+    return [data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+
+
+def slicing_reader(chunks):
+    buffer = bytearray()
+    count = 0
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= 2:
+            size = int.from_bytes(buffer[:2], 'little')
+            if len(buffer) < size + 2:
+                break
+            dgi = Datagram(bytes(buffer[2:size + 2])).iterator()
+            del buffer[:size + 2]
+            dgi.get_uint8()
+            count += 1
+    return count
+
+
+def frame_reader(chunks):
+    reader = FrameReader()
+    count = 0
+    for chunk in chunks:
+        reader.feed(chunk)
+        for dgi in reader:
+            dgi.get_uint8()
+            count += 1
+    return count
+
+
+def frame_writer(datagrams):
+    writer = FrameWriter()
+    writer.add_datagrams(datagrams)
+    return len(writer.take())
+
+
+def rate(func, arg, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return NUM_FRAMES / best
+
+
+def main():
+    datagrams = make_datagrams()
+    chunks = make_stream(datagrams)
+    assert slicing_reader(chunks) == frame_reader(chunks) == NUM_FRAMES
+
+    print(f'{NUM_FRAMES} frames of {len(datagrams[0])} bytes, read in {CHUNK_SIZE} byte chunks')
+    print(f'slicing reader {rate(slicing_reader, chunks) / 1e6:6.2f} M frames/s')
+    print(f'FrameReader    {rate(frame_reader, chunks) / 1e6:6.2f} M frames/s')
+    print(f'FrameWriter    {rate(frame_writer, datagrams) / 1e6:6.2f} M frames/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Field and class lookup latency on the toontown schema.
+
+Compares the weakref-based tables DCFile and DClass used to keep (a list of weakref.ref for fields and
+WeakValueDictionary for names and numbers) with the plain lists and dicts they hold now, and getattr on an object
+with calling the getter DClass caches per class.
+"""
+import os
+import timeit
+
+from weakref import ref, WeakValueDictionary
+
+from dc import parser
+
+TESTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests')
+FILES = [os.path.join(TESTS, 'otp.dc'), os.path.join(TESTS, 'toon.dc')]
+
+
+def timed(stmt, namespace, number=200000):
+    return min(timeit.repeat(stmt, globals=namespace, number=number, repeat=5)) / number
+
+
+class Toon:
+    def getName(self):
+        return 'Flippy'
+
+
+def main():
+    dcfile = parser.parse_dc_files(FILES, backend='fast')
+    dclass = dcfile.namespace['DistributedToon']
+    field = dclass['setName']
+
+    namespace = {
+        'fields': dcfile.fields,
+        'field_refs': [ref(f) for f in dcfile.fields],
+        'by_index': dclass.fields_by_index,
+        'weak_by_index': WeakValueDictionary(dclass.fields_by_index),
+        'by_name': dclass.fields_by_name,
+        'weak_by_name': WeakValueDictionary(dclass.fields_by_name),
+        'namespace': dcfile.namespace,
+        'weak_namespace': WeakValueDictionary(dcfile.namespace),
+        'number': field.number,
+        'obj': Toon(),
+        'methods': dclass.get_methods(Toon),
+    }
+
+    cases = [
+        ('field by number', 'field_refs[number]()', 'fields[number]'),
+        ('class field by number', 'weak_by_index[number]', 'by_index[number]'),
+        ('class field by name', "weak_by_name['setName']", "by_name['setName']"),
+        ('class by name', "weak_namespace['DistributedToon']", "namespace['DistributedToon']"),
+        ('field getter', "getattr(obj, 'getName')()", "methods['getName'](obj)"),
+    ]
+
+    print(f'{"lookup":<24} {"old":>10} {"new":>10}')
+    for name, old, new in cases:
+        assert eval(old, namespace) is eval(new, namespace)
+        print(f'{name:<24} {timed(old, namespace) * 1e9:7.1f} ns {timed(new, namespace) * 1e9:7.1f} ns')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Startup cost of loading the toontown schema (otp.dc + toon.dc).
+
+Compares building the LALR tables from the grammar on every call (the old behaviour), reusing the
+shared parser, loading the serialized tables from disk in a fresh parser, and the recursive-descent
+backend.
+"""
+import os
+import tempfile
+import time
+
+from lark import Lark
+
+from dc import parser
+from dc.lexer import LEXER
+
+TESTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests')
+FILES = [os.path.join(TESTS, 'otp.dc'), os.path.join(TESTS, 'toon.dc')]
+
+
+def timed(func, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def build_grammar():
+    Lark(LEXER, start='dc_file', parser='lalr', lexer='contextual', transformer=parser.DCFileTransformer())
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        table_cache = os.path.join(tmp, 'dc_parser.cache')
+        parser.load_parser(cache=table_cache)
+
+        build = timed(build_grammar)
+        load = timed(lambda: parser.load_parser(cache=table_cache))
+        parse = timed(lambda: parser.parse_dc_files(FILES))
+        fast = timed(lambda: parser.parse_dc_files(FILES, backend='fast'))
+
+    print(f'grammar build:          {build * 1000:8.2f} ms')
+    print(f'table load from cache:  {load * 1000:8.2f} ms')
+    print(f'parse otp.dc + toon.dc: {parse * 1000:8.2f} ms')
+    print()
+    print(f'per call, rebuilding grammar: {(build + parse) * 1000:8.2f} ms')
+    print(f'per call, shared parser:      {parse * 1000:8.2f} ms')
+    print(f'cold start, cached tables:    {(load + parse) * 1000:8.2f} ms')
+    print(f'fast backend:                 {fast * 1000:8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Unpacking an array of structs built around a switch with many cases.
+
+Compares scanning the cases in order for every element (the old behaviour) with DSwitch's value to case
+table and with the compiled field codec, which looks up a precompiled decoder per case.
+"""
+import timeit
+
+from dc.parser import parse_dc
+from dc.util import Datagram
+
+NUM_CASES = 64
+NUM_BUFFS = 200
+
+
+def schema():
+    cases = []
+    for value in range(NUM_CASES):
+        parameters = ''.join(f'    uint16 val{i};\n' for i in range(value % 4))
+        cases.append(f'  case {value}:\n{parameters}    break;\n')
+
+    return ('struct BuffData {\n  switch (uint8) {\n%s  };\n};\n\n'
+            'dclass Avatar {\n  setBuffs(BuffData []) broadcast;\n};\n' % ''.join(cases))
+
+
+def linear_unpack(switch, dgi):
+    first = switch.dtype.unpack_value(dgi)
+
+    for case in switch.cases:
+        if case.value == first:
+            rest = [parameter.unpack_value(dgi) for parameter in case.parameters]
+            break
+    else:
+        rest = [parameter.unpack_value(dgi) for parameter in switch.default_case.parameters]
+
+    return tuple([first] + rest)
+
+
+def unpack_all(unpack, switch, dg):
+    dgi = dg.iterator()
+    dgi.get_uint16()
+    while dgi.remaining():
+        unpack(switch, dgi)
+
+
+def timed(func, number=200):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def main():
+    dcfile = parse_dc(schema(), backend='fast')
+    field = dcfile.namespace['Avatar']['setBuffs']
+    switch = dcfile.namespace['BuffData'].fields[0].parameter
+
+    print(f'{NUM_BUFFS} elements, {NUM_CASES} cases')
+    for label, values in (('first case', [0] * NUM_BUFFS), ('last case', [NUM_CASES - 1] * NUM_BUFFS),
+                          ('mixed cases', [i % NUM_CASES for i in range(NUM_BUFFS)])):
+        buffs = [[(value,) + (7,) * (value % 4)] for value in values]
+        dg = Datagram()
+        field.pack_value(dg, (buffs,))
+        assert field.unpack_value(dg.iterator()) == (buffs,)
+
+        times = (timed(lambda: unpack_all(linear_unpack, switch, dg)),
+                 timed(lambda: unpack_all(switch.__class__.unpack_value, switch, dg)),
+                 timed(lambda: field.unpack_value(dg.iterator())))
+        print(f'{label:<12} linear scan {times[0] * 1e6:8.1f} us   case table {times[1] * 1e6:8.1f} us'
+              f'   codec {times[2] * 1e6:8.1f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+import hashlib
+import marshal
+import os
+
+from dc.objects import *
+
+
+# Bump whenever the layout written by dump_dcfile or fastparser.parse_declarations changes.
+CACHE_VERSION = 3
+
+
+PARAMETER_TYPES = {cls.__name__: cls for cls in (IntParameter, FloatParameter, CharParameter, SizedParameter,
+                                                 ArrayParameter, StructParameter)}
+
+
+def read_source(fp):
+    # Stat before reading so that a write racing with us leaves a stale mtime rather than a stale digest.
+    st = os.stat(fp)
+    with open(fp, 'rb') as f:
+        data = f.read()
+
+    return data, (fp, st.st_size, st.st_mtime_ns, hashlib.sha1(data).hexdigest())
+
+
+def _source_matches(entry):
+    # An unchanged size and mtime are trusted without reading the file. The digest is only checked when either
+    # of them differs, so that a file touched or copied without being edited keeps its cache entry.
+    fp, size, mtime_ns, digest = entry[:4]
+
+    try:
+        st = os.stat(fp)
+        if st.st_size == size and st.st_mtime_ns == mtime_ns:
+            return True
+
+        with open(fp, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest() == digest
+    except OSError:
+        return False
+
+
+def _dump_ranges(ranges):
+    if ranges is None:
+        return None
+
+    return tuple((r.min_n, r.max_n) for r in ranges)
+
+
+def _load_ranges(ranges):
+    if ranges is None:
+        return None
+
+    return [IRange(*r) for r in ranges]
+
+
+def _dump_parameter(parameter, class_numbers):
+    if isinstance(parameter, DSwitch):
+        cases = tuple(_dump_case(case, class_numbers) for case in parameter.cases)
+        default_case = None
+        if parameter.default_case is not None:
+            default_case = _dump_case(parameter.default_case, class_numbers)
+
+        return ('DSwitch', parameter.identifier, _dump_parameter(parameter.dtype, class_numbers), cases,
+                default_case)
+
+    dtype = parameter.dtype
+    if isinstance(dtype, str):
+        dtype = str(dtype)
+    else:
+        # Struct and class types are stored by their position in DCFile.classes.
+        dtype = class_numbers[dtype]
+
+    arange = getattr(parameter, 'arange', None)
+    if arange is not None:
+        arange = tuple(_dump_ranges(dimension) for dimension in arange)
+
+    return (parameter.__class__.__name__, dtype, parameter.identifier, _dump_ranges(parameter.vrange),
+            parameter.modulus, parameter.divisor, arange, parameter.default)
+
+
+def _load_parameter(data, dcfile):
+    if data[0] == 'DSwitch':
+        _, identifier, dtype, cases, default_case = data
+        cases = [_load_case(case, dcfile) for case in cases]
+        if default_case is not None:
+            default_case = _load_case(default_case, dcfile)
+
+        return DSwitch(_load_parameter(dtype, dcfile), cases, identifier=identifier, default_case=default_case)
+
+    kind, dtype, identifier, vrange, modulus, divisor, arange, default = data
+    if not isinstance(dtype, str):
+        dtype = dcfile.classes[dtype]
+
+    cls = PARAMETER_TYPES[kind]
+    kwargs = dict(dtype=dtype, identifier=identifier, vrange=_load_ranges(vrange), modulus=modulus,
+                  divisor=divisor, default=default)
+
+    if cls in (ArrayParameter, StructParameter):
+        if arange is not None:
+            arange = [_load_ranges(dimension) for dimension in arange]
+        kwargs['arange'] = arange
+
+    return cls(**kwargs)
+
+
+def _dump_case(case, class_numbers):
+    return case.value, tuple(_dump_parameter(p, class_numbers) for p in case.parameters), case.breaked
+
+
+def _load_case(data, dcfile):
+    value, parameters, breaked = data
+    return DSwitchCase(value, [_load_parameter(p, dcfile) for p in parameters], breaked)
+
+
+def _dump_field(field, class_numbers):
+    if isinstance(field, MolecularField):
+        return 'MolecularField', field.name, tuple(subfield.name for subfield in field.subfields)
+
+    keywords = tuple(str(kw) for kw in field.keywords)
+
+    if isinstance(field, ParameterField):
+        return 'ParameterField', _dump_parameter(field.parameter, class_numbers), keywords
+
+    return ('AtomicField', field.name, tuple(_dump_parameter(p, class_numbers) for p in field.parameters),
+            keywords)
+
+
+def _load_field(data, dcfile):
+    kind = data[0]
+
+    if kind == 'MolecularField':
+        return MolecularField(data[1], list(data[2]))
+
+    if kind == 'ParameterField':
+        return ParameterField(_load_parameter(data[1], dcfile), list(data[2]))
+
+    return AtomicField(data[1], [_load_parameter(p, dcfile) for p in data[2]], list(data[3]))
+
+
+def dump_dcfile(dcfile):
+    class_numbers = {dclass: i for i, dclass in enumerate(dcfile.classes)}
+
+    typedefs = tuple((str(t.old_type), str(t.new_type), _dump_ranges(t.ranges), t.modulus, t.divisor,
+                      None if t.aranges is None else tuple(_dump_ranges(a) for a in t.aranges))
+                     for t in dcfile.typedefs)
+
+    classes = []
+    for dclass in dcfile.classes:
+        constructor = None
+        if dclass.constructor is not None:
+            constructor = _dump_field(dclass.constructor, class_numbers)
+
+        classes.append((dclass.name, tuple(parent.name for parent in dclass.parents), dclass.is_struct, constructor,
+                        tuple(_dump_field(field, class_numbers) for field in dclass.fields)))
+
+    return typedefs, tuple(classes), len(dcfile.fields)
+
+
+def load_dcfile(data):
+    typedefs, classes, num_fields = data
+
+    dcfile = DCFile()
+
+    for old_type, new_type, ranges, modulus, divisor, aranges in typedefs:
+        if aranges is not None:
+            aranges = [_load_ranges(a) for a in aranges]
+        dcfile.add_typedef(TypeDef(old_type, new_type, _load_ranges(ranges), modulus, divisor, aranges))
+
+    # Mirrors DCFileTransformer.class_type and struct_type.
+    for name, parents, is_struct, constructor, fields in classes:
+        parents = [dcfile.namespace[parent] for parent in parents]
+        dclass = DClass(dcfile, name, parents, is_struct=is_struct)
+        dcfile.add_class(dclass)
+
+        if constructor is not None:
+            dclass.add_field(_load_field(constructor, dcfile))
+
+        for field in fields:
+            field = _load_field(field, dcfile)
+            if is_struct:
+                field.is_struct_field = True
+            dclass.add_field(field)
+
+        if not is_struct:
+            dclass.build_inherited_fields()
+
+    if len(dcfile.fields) != num_fields:
+        raise DCParseError('schema cache does not match its field count')
+
+    return dcfile
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            version, sources, dc_hash, schema = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+    if version != CACHE_VERSION:
+        return None
+
+    return sources, dc_hash, schema
+
+
+def read_cache(path, fps):
+    """Returns the cached DCFile for fps, or None if the cache is missing or stale."""
+    cached = _read(path)
+    if cached is None:
+        return None
+
+    sources, dc_hash, schema = cached
+    if [entry[0] for entry in sources] != list(fps):
+        return None
+
+    if not all(_source_matches(entry) for entry in sources):
+        return None
+
+    try:
+        dcfile = load_dcfile(schema)
+    except (DCParseError, KeyError, IndexError, TypeError, ValueError):
+        return None
+
+    if dcfile.hash != dc_hash:
+        return None
+
+    return dcfile
+
+
+def read_declarations(path):
+    """Maps each unchanged source in the cache at path to its source entry, declarations included.
+
+    Only sources parsed by the fast backend carry declarations; this lets a stale cache still skip
+    reparsing every file that was not edited.
+    """
+    cached = _read(path)
+    if cached is None:
+        return {}
+
+    return {entry[0]: entry for entry in cached[0] if entry[4] is not None and _source_matches(entry)}
+
+
+def write_cache(path, sources, dcfile):
+    data = marshal.dumps((CACHE_VERSION, tuple(sources), dcfile.hash, dump_dcfile(dcfile)))
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        # The cache is only an optimization; an unwritable location just means a full parse next time.
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
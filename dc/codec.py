@@ -0,0 +1,658 @@
+import struct
+
+from itertools import islice
+
+import numpy as np
+
+from dc.objects import *
+from dc.util import NativeCodec, ndarray_data
+
+
+# Scalar types that pack as a single struct format character.
+SCALAR_FORMATS = {
+    'int8': 'b',
+    'int16': 'h',
+    'int32': 'i',
+    'int64': 'q',
+    'uint8': 'B',
+    'uint16': 'H',
+    'uint32': 'I',
+    'uint64': 'Q',
+    'float64': 'd',
+    'char': 'B',
+
+    # Elements of the legacy array types.
+    'int8array': 'b',
+    'uint8array': 'B',
+    'int16array': 'h',
+    'uint16array': 'H',
+    'int32array': 'i',
+    'uint32array': 'I',
+}
+
+LEGACY_ARRAY_TYPES = frozenset(('int8array', 'uint8array', 'int16array', 'uint16array', 'int32array', 'uint32array',
+                                'uint32uint8array'))
+
+STRING_TYPES = frozenset(('string', 'blob', 'blob32'))
+
+# Types NativeCodec packs itself, and the element types of the arrays it handles.
+NATIVE_TYPES = {dtype: dtype for dtype in ('int8', 'int16', 'int32', 'int64', 'uint8', 'uint16', 'uint32', 'uint64',
+                                           'float64')}
+NATIVE_TYPES['char'] = 'uint8'
+
+NATIVE_ELEMENT_TYPES = dict(NATIVE_TYPES)
+NATIVE_ELEMENT_TYPES.update({dtype: dtype[:-5] for dtype in ('int8array', 'uint8array', 'int16array', 'uint16array',
+                                                             'int32array', 'uint32array')})
+
+UINT16 = struct.Struct('<H')
+UINT32 = struct.Struct('<I')
+UINT32_UINT8 = struct.Struct('<IB')
+
+add_bytes = Datagram.add_bytes
+add_string16 = Datagram.add_string16
+add_string32 = Datagram.add_string32
+get_bytes = DatagramIterator.get_bytes
+get_view = DatagramIterator.get_view
+skip_bytes = DatagramIterator.skip_bytes
+get_blob16 = DatagramIterator.get_blob16
+get_string16 = DatagramIterator.get_string16
+get_uint16 = DatagramIterator.get_uint16
+get_uint32 = DatagramIterator.get_uint32
+
+
+class FieldCodec:
+    """Pre-resolved encoder, decoder and skipper for one field, built by compile_field."""
+    __slots__ = 'pack', 'unpack', 'skip'
+
+    def __init__(self, pack, unpack, skip):
+        self.pack = pack
+        self.unpack = unpack
+        self.skip = skip
+
+
+# Items describe how one value is packed. Runs of 'fixed' items are merged into a single struct.Struct:
+#   ('fixed', format, value_count, pack_template, unpack_template, fallback_pack)
+#   ('opaque', pack, unpack)
+# fallback_pack is the parameter's own pack_value, used whenever struct rejects a value so that conversion
+# and range errors stay exactly what they were.
+
+
+def _fixed(fmt, count, pack_template, unpack_template, fallback):
+    return 'fixed', fmt, count, pack_template, unpack_template, fallback
+
+
+def _int_item(parameter):
+    fmt = SCALAR_FORMATS[parameter.dtype]
+    divisor = parameter.divisor
+
+    if divisor == 1:
+        return _fixed(fmt, 1, '{}', '{}', parameter.pack_value)
+
+    return _fixed(fmt, 1, 'int({} * %d)' % divisor, '{} // %d' % divisor, parameter.pack_value)
+
+
+def _parameter_item(parameter, numpy_arrays=False):
+    cls = parameter.__class__
+    dtype = parameter.dtype
+
+    if cls is IntParameter and dtype in SCALAR_FORMATS:
+        return _int_item(parameter)
+
+    if cls in (FloatParameter, CharParameter):
+        return _fixed(SCALAR_FORMATS[dtype], 1, '{}', '{}', parameter.pack_value)
+
+    if cls is SizedParameter:
+        return _sized_item(parameter)
+
+    if cls is ArrayParameter:
+        return _array_item(parameter, numpy_arrays)
+
+    if cls is StructParameter:
+        if not isinstance(dtype, str):
+            return ('opaque',) + _class_codec(dtype)
+
+        # Typedef'd builtins keep SimpleParameter semantics: no divisor and no range check.
+        if dtype in SCALAR_FORMATS and dtype not in LEGACY_ARRAY_TYPES:
+            return _fixed(SCALAR_FORMATS[dtype], 1, '{}', '{}', parameter.pack_value)
+
+    if cls is DSwitch:
+        return _switch_item(parameter)
+
+    return 'opaque', parameter.pack_value, parameter.unpack_value
+
+
+def _field_item(field):
+    if isinstance(field, ParameterField):
+        return _parameter_item(field.parameter)
+
+    codec = field.codec or field.compile()
+    return 'opaque', codec.pack, codec.unpack
+
+
+def _as_opaque(item):
+    if item[0] == 'opaque':
+        return item[1], item[2]
+
+    pack, unpack = _generate([item], 'value')
+    return pack, unpack
+
+
+def _encode_text(value):
+    if value.__class__ is str:
+        return value.encode('utf-8')
+    return value
+
+
+def _sized_codec(dtype, size):
+    if size:
+        def pack(dg, value):
+            value = _encode_text(value)
+            if len(value) != size:
+                raise DCParseError(f'expected {size} bytes for `{dtype}({size})`, got {len(value)}')
+            add_bytes(dg, value)
+
+        def unpack(dgi):
+            return get_bytes(dgi, size)
+
+        return pack, unpack
+
+    if dtype == 'blob32':
+        def pack(dg, value):
+            add_string32(dg, _encode_text(value))
+
+        def unpack(dgi):
+            return bytes(get_bytes(dgi, get_uint32(dgi)))
+
+        return pack, unpack
+
+    def pack(dg, value):
+        add_string16(dg, _encode_text(value))
+
+    return pack, get_string16 if dtype == 'string' else get_blob16
+
+
+def _sized_item(parameter):
+    return ('opaque',) + _sized_codec(parameter.dtype, parameter.fixed_byte_size)
+
+
+def _class_codec(dclass):
+    """Packs and unpacks a struct or class used as a parameter type."""
+    if dclass.codec is not None:
+        return dclass.codec
+
+    fields = dclass.fields
+    count = len(fields)
+    parameters = [field.parameter if isinstance(field, ParameterField) else None for field in fields]
+    pack_sequence, unpack = _compile(parameters, [_field_item(field) for field in fields], 'list')
+
+    # Sequences pack positionally, anything else through the field getters as before.
+    fallback = dclass.pack_fields_from_obj
+
+    def pack(dg, value):
+        if (value.__class__ is tuple or value.__class__ is list) and len(value) >= count:
+            pack_sequence(dg, value)
+        else:
+            fallback(dg, value)
+
+    dclass.codec = pack, unpack
+    return dclass.codec
+
+
+def _array_item(parameter, numpy_arrays=False):
+    dtype = parameter.dtype
+    arange = parameter.arange
+    fixed_array_size = parameter.fixed_array_size
+
+    # A single fixed-length dimension of fixed-size numbers is just more struct format characters.
+    if (not numpy_arrays and arange is not None and len(arange) == 1 and fixed_array_size and fixed_array_size[0]
+            and dtype in SCALAR_FORMATS and dtype not in LEGACY_ARRAY_TYPES):
+        count = fixed_array_size[0]
+        return _fixed('%d%s' % (count, SCALAR_FORMATS[dtype]), count, '*{}', 'list({})', parameter.pack_value)
+
+    if isinstance(dtype, str) and dtype not in SCALAR_FORMATS and dtype not in STRING_TYPES \
+            and dtype != 'uint32uint8array':
+        return 'opaque', parameter.pack_value, parameter.unpack_value
+
+    pack, unpack = _array_level(parameter, len(arange) - 1 if arange else 0, numpy_arrays)
+    return 'opaque', pack, unpack
+
+
+def _array_level(parameter, n, numpy_arrays=False):
+    """Mirrors ArrayParameter.pack_value and unpack_dimension for dimension n."""
+    dtype = parameter.dtype
+    is_blob32 = dtype == 'blob32'
+    header = UINT32 if is_blob32 else UINT16
+    get_length = get_uint32 if is_blob32 else get_uint16
+
+    fixed_size = None
+    if parameter.fixed_array_size and parameter.fixed_array_size[n]:
+        fixed_size = parameter.fixed_array_size[n] * parameter.fixed_byte_size
+
+    if n:
+        pack_element, unpack_element = _array_level(parameter, n - 1, numpy_arrays)
+        pack_data = None
+    else:
+        pack_element, unpack_element, pack_data = _array_element(parameter)
+
+    def unpack(dgi):
+        length = fixed_size if fixed_size is not None else get_length(dgi)
+        end = dgi.tell() + length
+        elements = []
+        while dgi.tell() < end:
+            elements.append(unpack_element(dgi))
+        return elements
+
+    if pack_data is not None:
+        # Leaf elements are encoded up front, so anything struct rejects falls back to the old packer untouched.
+        fallback = parameter.pack_value
+
+        def pack(dg, value):
+            try:
+                data = pack_data(value)
+            except (struct.error, TypeError, AttributeError):
+                return fallback(dg, value, 0)
+
+            if fixed_size is None:
+                add_bytes(dg, header.pack(len(data)) + data)
+            else:
+                add_bytes(dg, data)
+
+        if numpy_arrays and unpack_element is None:
+            element_dtype = np.dtype('<' + SCALAR_FORMATS[dtype])
+
+            # The arrays view the datagram's buffer rather than a copy of it.
+            def unpack(dgi):
+                length = fixed_size if fixed_size is not None else get_length(dgi)
+                return np.frombuffer(get_view(dgi, length), element_dtype)
+
+        elif n == 0 and fixed_size is None and unpack_element is None:
+            # Numeric elements unpack in one call as well.
+            fmt = '<%d' + SCALAR_FORMATS[dtype]
+            size = struct.calcsize(fmt % 1)
+
+            def unpack(dgi):
+                data = get_bytes(dgi, get_length(dgi))
+                return list(struct.unpack(fmt % (len(data) // size), data))
+
+        elif unpack_element is None:
+            element = struct.Struct('<' + SCALAR_FORMATS[dtype])
+            unpack_element = element.unpack
+
+            def unpack(dgi):
+                data = get_bytes(dgi, fixed_size)
+                return [value for value, in element.iter_unpack(data)]
+
+        return pack, unpack
+
+    def pack(dg, value):
+        if fixed_size is not None:
+            for element in value:
+                pack_element(dg, element)
+            return
+
+        # Write length header now. Seek and overwrite it later.
+        header_pos = dg.tell()
+        add_bytes(dg, header.pack(0))
+        pre_pos = dg.tell()
+
+        for element in value:
+            pack_element(dg, element)
+
+        data_size = dg.tell() - pre_pos
+        if data_size:
+            post_pos = dg.tell()
+            dg.seek(header_pos)
+            add_bytes(dg, header.pack(data_size))
+            dg.seek(post_pos)
+
+    return pack, unpack
+
+
+def _array_element(parameter):
+    """Returns (pack_element, unpack_element, pack_data) for the innermost dimension.
+
+    pack_data encodes a whole list of elements to bytes when the elements allow it; unpack_element is None
+    for plain numbers, which the caller unpacks in bulk.
+    """
+    dtype = parameter.dtype
+
+    if not isinstance(dtype, str):
+        pack, unpack = _class_codec(dtype)
+        return pack, unpack, None
+
+    if dtype in STRING_TYPES:
+        pack_element, unpack_element = _sized_codec(dtype, parameter.fixed_byte_size)
+
+        if parameter.fixed_byte_size:
+            return pack_element, unpack_element, None
+
+        header = UINT32 if dtype == 'blob32' else UINT16
+
+        def pack_data(value):
+            parts = []
+            for element in value:
+                element = _encode_text(element)
+                parts.append(header.pack(len(element)))
+                parts.append(element)
+            return b''.join(parts)
+
+        return pack_element, unpack_element, pack_data
+
+    if dtype == 'uint32uint8array':
+        def pack_data(value):
+            return b''.join([UINT32_UINT8.pack(a, b) for a, b in value])
+
+        def unpack_element(dgi):
+            return list(UINT32_UINT8.unpack(get_bytes(dgi, 5)))
+
+        return None, unpack_element, pack_data
+
+    fmt = '<%d' + SCALAR_FORMATS[dtype]
+    element_dtype = np.dtype('<' + SCALAR_FORMATS[dtype])
+
+    def pack_data(value):
+        if value.__class__ is np.ndarray:
+            return ndarray_data(value, element_dtype)
+        return struct.pack(fmt % len(value), *value)
+
+    return None, None, pack_data
+
+
+def _switch_item(switch):
+    pack_value, unpack_value = _as_opaque(_parameter_item(switch.dtype))
+
+    def compile_case(case):
+        return _generate([_parameter_item(parameter) for parameter in case.parameters], 'tuple')
+
+    # Cases sharing a body also share its compiled codec.
+    compiled = {}
+    cases = {}
+    for value, case in switch.cases_by_value.items():
+        key = id(case.parameters)
+        if key not in compiled:
+            compiled[key] = compile_case(case)
+        cases[value] = compiled[key]
+    default_case = None if switch.default_case is None else compile_case(switch.default_case)
+
+    def find_case(value):
+        case = cases.get(value, default_case)
+        if case is None:
+            raise DCParseError(f'no case for value `{value}` in switch `{switch.identifier}`')
+
+        return case
+
+    def pack(dg, values):
+        values = tuple(values)
+        pack_value(dg, values[0])
+        find_case(values[0])[0](dg, values[1:])
+
+    def unpack(dgi):
+        first = unpack_value(dgi)
+        return (first,) + find_case(first)[1](dgi)
+
+    return 'opaque', pack, unpack
+
+
+_code_cache = {}
+
+
+def _generate(items, mode, name=''):
+    """Generates pack and unpack functions for a sequence of items.
+
+    mode is 'value' for a single item, 'tuple' for atomic field arguments, 'molecular' for the flattened
+    arguments of a molecular field and 'list' for the fields of a struct.
+    """
+    namespace = {'add_bytes': add_bytes, 'get_bytes': get_bytes, 'error': struct.error, 'islice': islice,
+                 'fallback': _fallback, 'missing': _missing(name)}
+    count = len(items)
+
+    if mode == 'value':
+        pack_lines = ['def pack(dg, value):']
+        arguments = ['value']
+    else:
+        pack_lines = ['def pack(dg, args):']
+        arguments = ['args[%d]' % i for i in range(count)]
+
+    if mode == 'tuple' and count:
+        # Allow generator usage for getters while also ensuring we pack all required parameters.
+        pack_lines += ['    if args.__class__ is not tuple and args.__class__ is not list:',
+                       '        args = tuple(islice(args, %d))' % count,
+                       '    if len(args) < %d:' % count,
+                       '        raise missing(args)']
+    elif mode == 'molecular':
+        pack_lines.append('    assert len(args) == %d' % count)
+
+    unpack_lines = ['def unpack(dgi):']
+    results = []
+
+    i = 0
+    run = 0
+    while i < count:
+        item = items[i]
+
+        if item[0] == 'opaque':
+            namespace['p%d' % i] = item[1]
+            namespace['u%d' % i] = item[2]
+            pack_lines.append('    p%d(dg, %s)' % (i, arguments[i]))
+            unpack_lines.append('    v%d = u%d(dgi)' % (i, i))
+            results.append('v%d' % i)
+            i += 1
+            continue
+
+        j = i
+        while j < count and items[j][0] == 'fixed':
+            j += 1
+
+        layout = struct.Struct('<' + ''.join(item[1] for item in items[i:j]))
+        namespace['s%d' % run] = layout
+        namespace['f%d' % run] = tuple(item[5] for item in items[i:j])
+
+        values = ', '.join(item[3].format(argument) for item, argument in zip(items[i:j], arguments[i:j]))
+        pack_lines += ['    try:',
+                       '        add_bytes(dg, s%d.pack(%s))' % (run, values),
+                       '    except error:',
+                       '        fallback(dg, f%d, (%s,))' % (run, ', '.join(arguments[i:j]))]
+
+        unpack_lines.append('    r%d = s%d.unpack(get_bytes(dgi, %d))' % (run, run, layout.size))
+        offset = 0
+        for item in items[i:j]:
+            if item[2] == 1:
+                results.append(item[4].format('r%d[%d]' % (run, offset)))
+            else:
+                results.append(item[4].format('r%d[%d:%d]' % (run, offset, offset + item[2])))
+            offset += item[2]
+
+        run += 1
+        i = j
+
+    if len(pack_lines) == 1:
+        pack_lines.append('    pass')
+
+    if mode == 'value':
+        unpack_lines.append('    return ' + results[0])
+    elif mode == 'tuple':
+        unpack_lines.append('    return (%s)' % ''.join(result + ', ' for result in results))
+    else:
+        unpack_lines.append('    return [%s]' % ', '.join(results))
+
+    source = '\n'.join(pack_lines + unpack_lines) + '\n'
+
+    # Fields with the same shape share their bytecode; only the namespace differs.
+    code = _code_cache.get(source)
+    if code is None:
+        code = _code_cache[source] = compile(source, '<dc codec>', 'exec')
+
+    # Defining the functions outside their globals keeps them from referencing themselves in a cycle.
+    functions = {}
+    exec(code, namespace, functions)
+    return functions['pack'], functions['unpack']
+
+
+def _skipper(packables):
+    """Skips the values of packables, moving past each run of fixed-size values in one step."""
+    steps = []
+    size = 0
+    for packable in packables:
+        fixed_size = packable.get_fixed_size()
+        if fixed_size is None:
+            if size:
+                steps.append(size)
+                size = 0
+            steps.append(packable.skip_value)
+        else:
+            size += fixed_size
+
+    if not steps:
+        def skip(dgi):
+            skip_bytes(dgi, size)
+
+        return skip
+
+    if size:
+        steps.append(size)
+
+    if len(steps) == 1:
+        return steps[0]
+
+    def skip(dgi):
+        for step in steps:
+            if step.__class__ is int:
+                skip_bytes(dgi, step)
+            else:
+                step(dgi)
+
+    return skip
+
+
+def _fallback(dg, packers, values):
+    for pack, value in zip(packers, values):
+        pack(dg, value)
+
+
+def _missing(name):
+    def missing(args):
+        return DCParseError(f'Missing parameters for field: {name}. args={list(args)}')
+
+    return missing
+
+
+def _native_op(parameter, item, numpy_arrays=False):
+    """Describes parameter for NativeCodec, or hands it the item's Python pack and unpack."""
+    cls = parameter.__class__
+    dtype = parameter.dtype
+
+    if cls is IntParameter and dtype in NATIVE_TYPES:
+        return NATIVE_TYPES[dtype], parameter.divisor, True, None, None
+
+    if cls is FloatParameter:
+        return 'float64', 1, False, None, None
+
+    if cls is CharParameter:
+        return 'uint8', 1, False, None, None
+
+    if cls is StructParameter and dtype in NATIVE_TYPES:
+        return NATIVE_TYPES[dtype], 1, False, None, None
+
+    if cls is SizedParameter and not parameter.fixed_byte_size:
+        return dtype, 1, False, None, None
+
+    # NativeCodec unpacks arrays to lists; NumPy results come from the Python item.
+    if cls is ArrayParameter and not numpy_arrays and dtype in NATIVE_ELEMENT_TYPES \
+            and (not parameter.arange or len(parameter.arange) == 1):
+        fixed_array_size = parameter.fixed_array_size
+        if fixed_array_size and fixed_array_size[0]:
+            if dtype in LEGACY_ARRAY_TYPES:
+                return _as_opaque(item)
+            return NATIVE_ELEMENT_TYPES[dtype], 1, False, fixed_array_size[0], parameter.pack_value
+        return NATIVE_ELEMENT_TYPES[dtype], 1, False, 0, parameter.pack_value
+
+    return _as_opaque(item)
+
+
+def _compile(parameters, items, mode, name='', numpy_arrays=False):
+    """Generates the Python codec for items and, when any parameter allows it, a NativeCodec on top.
+
+    parameters lines up with items; None marks items that are not a plain parameter.
+    """
+    pack, unpack = _generate(items, mode, name)
+
+    ops = [_as_opaque(item) if parameter is None else _native_op(parameter, item, numpy_arrays)
+           for parameter, item in zip(parameters, items)]
+    if not any(len(op) == 5 for op in ops):
+        return pack, unpack
+
+    native = NativeCodec(ops, mode, pack)
+    return native.pack, native.unpack
+
+
+def compile_block(fields, numpy_arrays=False):
+    """Builds a FieldCodec packing consecutive fields, such as a class's required fields, as one field.
+
+    pack takes and unpack returns a list with one value per field, as for the fields' own codecs. All the
+    parameters are flattened into one sequence, so a block of fixed-size fields is a single struct.
+    """
+    parameters = []
+    namespace = {'islice': islice}
+    pack_lines = ['def pack(dg, values):']
+    flat = []
+    results = []
+
+    for i, field in enumerate(fields):
+        if isinstance(field, ParameterField):
+            flat.append('values[%d]' % i)
+            results.append('r[%d]' % len(parameters))
+            parameters.append(field.parameter)
+            continue
+
+        count = len(field.parameters)
+        if count:
+            namespace['missing%d' % i] = _missing(field.name)
+            pack_lines += ['    v%d = values[%d]' % (i, i),
+                           '    if v%d.__class__ is not tuple and v%d.__class__ is not list:' % (i, i),
+                           '        v%d = tuple(islice(v%d, %d))' % (i, i, count),
+                           '    if len(v%d) < %d:' % (i, count),
+                           '        raise missing%d(v%d)' % (i, i)]
+            flat += ['v%d[%d]' % (i, j) for j in range(count)]
+
+        results.append('(%s)' % ''.join('r[%d], ' % (len(parameters) + j) for j in range(count)))
+        parameters += field.parameters
+
+    namespace['pack_flat'], namespace['unpack_flat'] = _compile(
+        parameters, [_parameter_item(p, numpy_arrays) for p in parameters], 'list', numpy_arrays=numpy_arrays)
+
+    pack_lines.append('    pack_flat(dg, [%s])' % ', '.join(flat))
+    unpack_lines = ['def unpack(dgi):',
+                    '    r = unpack_flat(dgi)',
+                    '    return [%s]' % ', '.join(results)]
+
+    source = '\n'.join(pack_lines + unpack_lines) + '\n'
+    code = _code_cache.get(source)
+    if code is None:
+        code = _code_cache[source] = compile(source, '<dc codec>', 'exec')
+
+    functions = {}
+    exec(code, namespace, functions)
+    return FieldCodec(functions['pack'], functions['unpack'], _skipper(fields))
+
+
+def compile_field(field, numpy_arrays=False):
+    """Builds the FieldCodec used by field.pack_value and field.unpack_value.
+
+    With numpy_arrays, the field's own numeric arrays unpack to little-endian ndarrays viewing the bytes read
+    rather than to lists. ndarrays are accepted when packing either way.
+    """
+    if isinstance(field, ParameterField):
+        parameters = [field.parameter]
+        mode = 'value'
+    elif isinstance(field, AtomicField):
+        parameters = field.parameters
+        mode = 'tuple'
+    elif all(isinstance(subfield, AtomicField) for subfield in field.subfields):
+        # Atomic subfields just take consecutive slices of the arguments, so pack them as one field.
+        parameters = [p for subfield in field.subfields for p in subfield.parameters]
+        mode = 'molecular'
+    else:
+        return FieldCodec(field.pack_subfields, field.unpack_subfields, _skipper(field.subfields))
+
+    items = [_parameter_item(p, numpy_arrays) for p in parameters]
+    return FieldCodec(*_compile(parameters, items, mode, field.name, numpy_arrays), _skipper(parameters))
@@ -0,0 +1,616 @@
+import re
+
+from dc.objects import *
+
+
+INT_TYPES = frozenset(('int8', 'int16', 'int32', 'int64', 'uint8', 'uint16', 'uint32', 'uint64'))
+FLOAT_TYPES = frozenset(('float64',))
+CHAR_TYPES = frozenset(('char',))
+SIZED_TYPES = frozenset(('string', 'blob', 'blob32'))
+ARRAY_TYPES = frozenset(('int8array', 'int16array', 'int32array', 'uint8array', 'uint16array', 'uint32array',
+                         'uint32uint8array'))
+BUILTIN_TYPES = INT_TYPES | FLOAT_TYPES | CHAR_TYPES | SIZED_TYPES | ARRAY_TYPES
+
+# Words the Lark lexer turns into HISTORIC_KW, which can never name a parameter field.
+HISTORIC_KW = frozenset(('required', 'broadcast', 'ownrecv', 'ram', 'db', 'clsend', 'clrecv', 'airecv'))
+
+
+# Comments match without a group so findall yields '' for them.
+TOKEN_RE = re.compile(r'''
+    //[^\n]*
+  | /\*.*?\*/
+  | ( \d+\.\d*
+    | \.\d+
+    | 0[xX][0-9a-fA-F]+ | 0[oO][0-7]+ | 0[bB][01]+ | \d+
+    | [A-Za-z_][A-Za-z0-9_]*
+    | "(?:[^"\\]|\\.)*"
+    | '(?:[^'\\]|\\.)*'
+    | \S
+    )
+''', re.VERBOSE | re.DOTALL)
+
+ESCAPE_RE = re.compile(r'\\(?:x([0-9a-fA-F]+)|(.))', re.DOTALL)
+
+OPERATORS = frozenset('{}()[];:,=%/*-.')
+
+
+def _unescape(match):
+    if match.group(1) is not None:
+        return chr(int(match.group(1), 16))
+
+    # Same as the Lark grammar: any other escaped character stands for itself.
+    return match.group(2)
+
+
+def _classify(text):
+    c = text[0]
+
+    if c.isalpha() or c == '_':
+        return 'word', text
+    if c in '"\'':
+        return 'str' if c == '"' else 'char', ESCAPE_RE.sub(_unescape, text[1:-1])
+    if c.isdigit() or (c == '.' and len(text) > 1):
+        if '.' in text:
+            return 'float', float(text)
+        if text[:2].lower() in ('0x', '0o', '0b'):
+            return 'int', int(text, 0)
+        return 'int', int(text)
+    if text in OPERATORS:
+        return text, text
+
+    return None
+
+
+def tokenize(data):
+    """Splits DC source into parallel lists of token kinds and values, ending with an eof token."""
+    kinds = []
+    values = []
+    classified = {}
+
+    for text in TOKEN_RE.findall(data):
+        if not text:
+            continue
+
+        # DC files repeat the same few thousand words, so classify each distinct one only once.
+        token = classified.get(text)
+        if token is None:
+            token = classified[text] = _classify(text)
+            if token is None:
+                raise DCParseError(f'line {_token_line(data, len(kinds))}: unexpected character {text!r}')
+
+        kinds.append(token[0])
+        values.append(token[1])
+
+    kinds.append('eof')
+    values.append(None)
+
+    return kinds, values
+
+
+def _token_line(data, index):
+    # Offsets are only needed for error messages, so recover them by scanning again.
+    count = 0
+    for match in TOKEN_RE.finditer(data):
+        if match.group(1) is None:
+            continue
+        if count == index:
+            return data.count('\n', 0, match.start()) + 1
+        count += 1
+
+    return data.count('\n') + 1
+
+
+class DCParser:
+    """Recursive-descent DC parser producing the plain declaration tuples consumed by build().
+
+    Declarations only hold strings, numbers and tuples, so they need no DCFile to be produced and can be
+    cached with marshal independently of the files parsed before them.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.kinds, self.values = tokenize(data)
+        self.pos = 0
+
+    def error(self, expected):
+        line = _token_line(self.data, self.pos)
+        got = 'end of file' if self.kinds[self.pos] == 'eof' else repr(self.values[self.pos])
+        return DCParseError(f'line {line}: expected {expected}, got {got}')
+
+    def accept(self, kind):
+        if self.kinds[self.pos] == kind:
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind):
+        if self.kinds[self.pos] != kind:
+            raise self.error(repr(kind))
+        self.pos += 1
+
+    def word(self):
+        if self.kinds[self.pos] != 'word':
+            raise self.error('identifier')
+        value = self.values[self.pos]
+        self.pos += 1
+        return value
+
+    def peek_word(self):
+        if self.kinds[self.pos] == 'word':
+            return self.values[self.pos]
+        return None
+
+    def parse(self):
+        declarations = []
+
+        while self.kinds[self.pos] != 'eof':
+            if self.accept(';'):
+                continue
+
+            keyword = self.word()
+
+            if keyword == 'dclass':
+                declarations.append(self.parse_class(is_struct=False))
+            elif keyword == 'struct':
+                declarations.append(self.parse_class(is_struct=True))
+            elif keyword == 'typedef':
+                declarations.append(self.parse_typedef())
+            elif keyword == 'keyword':
+                # Keyword declarations are not recorded, matching DCFileTransformer.
+                self.word()
+                self.accept(';')
+            elif keyword in ('from', 'import'):
+                self.parse_import(keyword)
+            else:
+                self.pos -= 1
+                raise self.error('declaration')
+
+        return tuple(declarations)
+
+    def parse_import(self, keyword):
+        if keyword == 'from':
+            self.parse_module_name()
+            if self.word() != 'import':
+                self.pos -= 1
+                raise self.error("'import'")
+
+        if self.accept('*'):
+            return
+
+        self.parse_module_name()
+        while self.accept(','):
+            self.parse_module_name()
+
+    def parse_module_name(self):
+        self.word()
+        while self.kinds[self.pos] in ('.', '/'):
+            self.pos += 1
+            self.word()
+
+    def parse_typedef(self):
+        type_name = self.word()
+
+        if type_name in BUILTIN_TYPES:
+            ranges, modulus, divisor = self.parse_constraints(type_name)
+        else:
+            ranges, modulus, divisor = (), None, 1
+
+        new_type = self.word()
+
+        array_ranges = None
+        while self.accept('['):
+            if array_ranges is None:
+                array_ranges = ()
+            array_ranges += (self.parse_array_range(),)
+
+        self.expect(';')
+        return 'typedef', type_name, new_type, ranges, modulus, divisor, array_ranges
+
+    def parse_class(self, is_struct):
+        name = self.word()
+
+        parents = []
+        if self.accept(':'):
+            parents.append(self.word())
+            while self.accept(','):
+                parents.append(self.word())
+
+        self.expect('{')
+        fields = []
+        while not self.accept('}'):
+            fields.append(self.parse_field())
+            self.expect(';')
+        self.expect(';')
+
+        return 'class', name, tuple(parents), is_struct, tuple(fields)
+
+    def parse_field(self):
+        name = self.peek_word()
+
+        if name is not None and name not in BUILTIN_TYPES and name != 'switch':
+            next_kind = self.kinds[self.pos + 1]
+
+            if next_kind == ':':
+                self.pos += 2
+                subfields = [self.word()]
+                while self.accept(','):
+                    subfields.append(self.word())
+                return 'molecular', name, tuple(subfields)
+
+            if next_kind == '(':
+                self.pos += 2
+                parameters = []
+                if not self.accept(')'):
+                    parameters.append(self.parse_parameter())
+                    while self.accept(','):
+                        parameters.append(self.parse_parameter())
+                    self.expect(')')
+                return 'atomic', name, tuple(parameters), self.parse_keywords()
+
+        if name == 'switch':
+            parameter = self.parse_switch()
+        else:
+            parameter = self.parse_parameter(is_field=True)
+
+        return 'parameter', parameter, self.parse_keywords()
+
+    def parse_keywords(self):
+        kinds = self.kinds
+        keywords = []
+
+        while kinds[self.pos] == 'word':
+            keywords.append(self.values[self.pos])
+            self.pos += 1
+            if kinds[self.pos] == ',' and kinds[self.pos + 1] == 'word':
+                self.pos += 1
+
+        return tuple(keywords)
+
+    def parse_parameter(self, is_field=False):
+        type_name = self.word()
+
+        if type_name in BUILTIN_TYPES:
+            vrange, modulus, divisor = self.parse_constraints(type_name)
+        else:
+            # Named types take their constraints from the typedef or class, resolved by build().
+            vrange, modulus, divisor = (), None, 1
+
+        identifier = self.peek_word()
+        if identifier is not None and not (is_field and identifier in HISTORIC_KW):
+            self.pos += 1
+        else:
+            identifier = None
+
+        array_ranges = None
+        if self.kinds[self.pos] == '[':
+            array_ranges = ()
+            while self.accept('['):
+                array_ranges += (self.parse_array_range(),)
+
+        default = self.parse_literal() if self.accept('=') else None
+
+        return 'param', type_name, identifier, vrange, modulus, divisor, array_ranges, default
+
+    def parse_constraints(self, type_name):
+        kinds = self.kinds
+        ranges = ()
+        modulus = None
+        divisor = 1
+
+        if type_name in SIZED_TYPES:
+            if kinds[self.pos] == '(':
+                ranges = self.parse_int_ranges()
+            return ranges, modulus, divisor
+
+        if type_name in CHAR_TYPES:
+            if kinds[self.pos] == '(':
+                ranges = self.parse_char_ranges()
+            return ranges, modulus, divisor
+
+        is_float = type_name in FLOAT_TYPES
+
+        while True:
+            kind = kinds[self.pos]
+            if kind == '(':
+                ranges = self.parse_float_ranges() if is_float else self.parse_int_ranges()
+            elif kind == '%':
+                self.pos += 1
+                modulus = int(self.parse_number() if is_float else self.parse_int())
+            elif kind == '/':
+                self.pos += 1
+                divisor = int(self.parse_number() if is_float else self.parse_int())
+            else:
+                break
+
+        if is_float:
+            if modulus is not None and modulus < 0:
+                raise DCParseError('Negative modulus not allowed.')
+
+            if divisor == 0:
+                raise DCParseError('Division by zero')
+
+            if divisor < 0:
+                raise DCParseError('Negative divisor not allowed.')
+
+        return ranges, modulus, divisor
+
+    def parse_int(self):
+        negative = self.accept('-')
+        if self.kinds[self.pos] != 'int':
+            raise self.error('integer')
+        value = self.values[self.pos]
+        self.pos += 1
+        return -value if negative else value
+
+    def parse_number(self):
+        negative = self.accept('-')
+        if self.kinds[self.pos] not in ('int', 'float'):
+            raise self.error('number')
+        value = self.values[self.pos]
+        self.pos += 1
+        return -value if negative else value
+
+    def parse_int_range(self):
+        min_n = self.parse_int()
+        max_n = self.parse_int() if self.accept('-') else min_n
+        return min_n, max_n
+
+    def parse_int_ranges(self):
+        self.expect('(')
+        ranges = [self.parse_int_range()]
+        while self.accept(','):
+            ranges.append(self.parse_int_range())
+        self.expect(')')
+        return tuple(ranges)
+
+    def parse_float_ranges(self):
+        self.expect('(')
+        ranges = []
+        while True:
+            min_n = self.parse_number()
+            max_n = self.parse_number() if self.accept('-') else min_n
+            ranges.append((min_n, max_n))
+            if not self.accept(','):
+                break
+        self.expect(')')
+        return tuple(ranges)
+
+    def parse_char_ranges(self):
+        self.expect('(')
+        ranges = []
+        while True:
+            if self.kinds[self.pos] == 'char':
+                c = ord(self.values[self.pos])
+                self.pos += 1
+                ranges.append((c, c))
+            else:
+                ranges.append(self.parse_int_range())
+            if not self.accept(','):
+                break
+        self.expect(')')
+        return tuple(ranges)
+
+    def parse_array_range(self):
+        # The opening bracket has already been consumed.
+        ranges = []
+        if not self.accept(']'):
+            ranges.append(self.parse_int_range())
+            while self.accept(','):
+                ranges.append(self.parse_int_range())
+            self.expect(']')
+        return tuple(ranges)
+
+    def parse_literal(self):
+        if not self.accept('{'):
+            return self.parse_case_value()
+
+        # Array literals become lists, nested for each dimension.
+        values = [self.parse_literal()]
+        while self.accept(','):
+            values.append(self.parse_literal())
+        self.expect('}')
+        return values
+
+    def parse_case_value(self):
+        kind = self.kinds[self.pos]
+        if kind in ('str', 'char'):
+            self.pos += 1
+            return self.values[self.pos - 1]
+        return self.parse_number()
+
+    def parse_switch(self):
+        self.pos += 1  # switch
+
+        identifier = ''
+        if self.kinds[self.pos] == 'word':
+            identifier = self.word()
+
+        self.expect('(')
+        switched_parameter = self.parse_parameter()
+        self.expect(')')
+        self.expect('{')
+
+        # Each body is kept once together with all of its labels; build() makes the cases share it.
+        bodies = []
+        labels = []
+
+        while not self.accept('}'):
+            keyword = self.peek_word()
+
+            if keyword == 'case':
+                self.pos += 1
+                labels.append(self.parse_case_value())
+                self.expect(':')
+                continue
+
+            if keyword == 'default':
+                self.pos += 1
+                self.expect(':')
+                labels.append(None)
+                continue
+
+            if not labels:
+                raise self.error("'case'")
+
+            parameters = []
+            breaked = False
+            while True:
+                keyword = self.peek_word()
+                if keyword == 'break':
+                    self.pos += 1
+                    breaked = True
+                    break
+
+                if keyword in ('case', 'default') or self.kinds[self.pos] == '}':
+                    break
+
+                if not self.accept(';'):
+                    parameters.append(self.parse_parameter())
+                    self.expect(';')
+
+            self.accept(';')
+            bodies.append((tuple(labels), tuple(parameters), breaked))
+            del labels[:]
+
+        if labels:
+            raise self.error('case parameters')
+
+        return 'switch', identifier, switched_parameter, tuple(bodies)
+
+
+PARAMETER_CLASSES = {}
+PARAMETER_CLASSES.update(dict.fromkeys(INT_TYPES, IntParameter))
+PARAMETER_CLASSES.update(dict.fromkeys(FLOAT_TYPES, FloatParameter))
+PARAMETER_CLASSES.update(dict.fromkeys(CHAR_TYPES, CharParameter))
+PARAMETER_CLASSES.update(dict.fromkeys(SIZED_TYPES, SizedParameter))
+PARAMETER_CLASSES.update(dict.fromkeys(ARRAY_TYPES, ArrayParameter))
+
+
+def _build_ranges(ranges):
+    return tuple(IRange(min_n, max_n) for min_n, max_n in ranges)
+
+
+def _build_array_ranges(array_ranges):
+    if array_ranges is None:
+        return None
+
+    return [_build_ranges(dimension) for dimension in array_ranges]
+
+
+def _build_parameter(dcfile, declaration):
+    if declaration[0] == 'switch':
+        return _build_switch(dcfile, declaration)
+
+    _, type_name, identifier, vrange, modulus, divisor, array_ranges, default = declaration
+    vrange = _build_ranges(vrange)
+    array_ranges = _build_array_ranges(array_ranges)
+
+    cls = PARAMETER_CLASSES.get(type_name)
+    if cls is None:
+        cls = StructParameter
+        dtype, data_info = dcfile.resolve_type(type_name)
+        if data_info is not None:
+            vrange, modulus, divisor, type_array_ranges = data_info
+            if type_array_ranges is not None:
+                array_ranges = type_array_ranges if array_ranges is None else type_array_ranges + array_ranges
+    else:
+        dtype = type_name
+
+    if array_ranges is not None:
+        return ArrayParameter(dtype=dtype, identifier=identifier, vrange=vrange, modulus=modulus,
+                              divisor=divisor, default=default, arange=array_ranges)
+    elif cls is StructParameter:
+        return StructParameter(dtype=dtype, identifier=identifier, vrange=vrange, modulus=modulus,
+                               divisor=divisor, default=default, arange=None)
+    elif cls is ArrayParameter:
+        return ArrayParameter(dtype=dtype, identifier=identifier, vrange=vrange, modulus=modulus,
+                              divisor=divisor, default=default, arange=None)
+
+    return cls(dtype=dtype, identifier=identifier, vrange=vrange, modulus=modulus, divisor=divisor,
+               default=default)
+
+
+def _build_switch(dcfile, declaration):
+    _, identifier, switched_parameter, bodies = declaration
+
+    # Cases sharing a body share its parameter list, as in DCFileTransformer.switch_body.
+    cases = []
+    for labels, parameters, breaked in bodies:
+        parameters = [_build_parameter(dcfile, parameter) for parameter in parameters]
+        cases.extend(DSwitchCase(label, parameters, breaked) for label in labels)
+
+    default_case = None
+    for case in cases:
+        if case.value is None:
+            default_case = case
+            break
+
+    if default_case is not None:
+        cases.remove(default_case)
+
+        for case in cases:
+            if not case.breaked:
+                case.parameters.extend(default_case.parameters)
+
+    return DSwitch(_build_parameter(dcfile, switched_parameter), cases, identifier=identifier,
+                   default_case=default_case)
+
+
+def _build_field(dcfile, declaration):
+    kind = declaration[0]
+
+    if kind == 'molecular':
+        return MolecularField(declaration[1], list(declaration[2]))
+
+    if kind == 'atomic':
+        return AtomicField(declaration[1], [_build_parameter(dcfile, p) for p in declaration[2]],
+                           list(declaration[3]))
+
+    return ParameterField(_build_parameter(dcfile, declaration[1]), list(declaration[2]))
+
+
+def _build_class(dcfile, declaration):
+    _, name, parents, is_struct, fields = declaration
+
+    try:
+        parents = [dcfile.namespace[parent] for parent in parents]
+    except KeyError as e:
+        raise DCParseError('unknown class', e.args[0])
+
+    # Fields are built before their class is registered, as the Lark transformer does.
+    fields = [_build_field(dcfile, field) for field in fields]
+
+    dclass = DClass(dcfile, name, parents, is_struct=is_struct)
+    dcfile.add_class(dclass)
+    for field in fields:
+        if is_struct:
+            field.is_struct_field = True
+        dclass.add_field(field)
+
+    if not is_struct:
+        dclass.build_inherited_fields()
+
+
+def parse_declarations(data):
+    """Parses DC source into a tuple of declarations without resolving any names."""
+    return DCParser(data).parse()
+
+
+def build(declarations, dcfile=None):
+    """Adds parsed declarations to dcfile in order, resolving names against what it already holds."""
+    if dcfile is None:
+        dcfile = DCFile()
+
+    for declaration in declarations:
+        if declaration[0] == 'class':
+            _build_class(dcfile, declaration)
+        else:
+            _, old_type, new_type, ranges, modulus, divisor, array_ranges = declaration
+            dcfile.add_typedef(TypeDef(old_type, new_type, _build_ranges(ranges), modulus, divisor,
+                                       _build_array_ranges(array_ranges)))
+
+    return dcfile
+
+
+def parse(data, dcfile=None):
+    return build(parse_declarations(data), dcfile)
@@ -1,4 +1,4 @@
-LEXER = r'''dc_file: type_decl ( type_decl )*
+LEXER = r'''dc_file: type_decl*
 
 type_decl: keyword_type | typedef_type | struct_type | class_type | import_decl
 
@@ -0,0 +1,201 @@
+import asyncio
+import collections
+
+from dc.util import Datagram, FrameReader, FrameWriter
+from dc.messagetypes import *
+
+
+class MDProtocol(asyncio.Protocol):
+    """A connection to a message director.
+
+    Iterating the protocol with async for yields a (targets, sender, msg_type, dgi) tuple for each datagram
+    received, with the targets as a tuple and dgi positioned after the server header. Datagrams passed to send
+    are written together once per event loop iteration; await drain to wait while the transport's buffer is full.
+    Consecutive field updates passed to update_field are held and sent as one message per object, in order with
+    the datagrams sent around them.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.loop = None
+        self.reader = FrameReader()
+        self.writer = FrameWriter()
+        self.messages = collections.deque()
+        self.updates = {}
+        self.waiter = None
+        self.flush_handle = None
+        self.paused = False
+        self.drain_waiters = collections.deque()
+        self.lost = False
+        self.exception = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        if len(self.writer) or self.updates:
+            self.schedule_flush()
+
+    def connection_lost(self, exc):
+        self.lost = True
+        if exc is not None:
+            self.exception = exc
+        self.wake(self.waiter)
+        self.wake_drainers(exc or ConnectionResetError('connection lost'))
+
+    def data_received(self, data):
+        self.reader.feed(data)
+
+        for dgi in self.reader:
+            try:
+                self.messages.append(dgi.get_server_header() + (dgi,))
+            except OverflowError as e:
+                # The frame is too short for a server header, so the connection is closed and iterating it raises
+                # the error once the messages before it have been read.
+                self.exception = e
+                self.transport.close()
+                break
+
+        if self.messages:
+            self.wake(self.waiter)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.wake_drainers()
+
+    @staticmethod
+    def wake(waiter, exc=None):
+        if waiter is None or waiter.done():
+            return
+
+        if exc is None:
+            waiter.set_result(None)
+        else:
+            waiter.set_exception(exc)
+
+    def wake_drainers(self, exc=None):
+        while self.drain_waiters:
+            self.wake(self.drain_waiters.popleft(), exc)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.messages:
+            if self.lost:
+                if self.exception is not None:
+                    raise self.exception
+                raise StopAsyncIteration
+
+            self.waiter = asyncio.get_running_loop().create_future()
+            await self.waiter
+
+        return self.messages.popleft()
+
+    def send(self, dg):
+        if self.updates:
+            # Queued updates go out ahead of anything sent after them.
+            self.write_updates()
+        self.writer.add_datagram(dg)
+        if self.transport is not None:
+            self.schedule_flush()
+
+    def update_field(self, do_id, to_id, from_id, field, args):
+        """Queues an update of the DCField field on do_id. Consecutive updates queued for the same object, target
+        and sender are sent together in one STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE message; anything sent after
+        them goes out after them."""
+        key = do_id, to_id, from_id
+        updates = self.updates.get(key)
+        if updates is None:
+            updates = self.updates[key] = []
+        updates.append((field, args))
+        if self.transport is not None:
+            self.schedule_flush()
+
+    def update_field_fanout(self, do_ids, from_id, field, args, to_ids=None):
+        """Sends the same update of the DCField field to each object in do_ids, packing args only once. The updates
+        go to to_ids, or to the objects' own channels."""
+        if self.updates:
+            self.write_updates()
+        self.writer.add_updates(field.ai_format_update(0, 0, from_id, args), do_ids, to_ids)
+        if self.transport is not None:
+            self.schedule_flush()
+
+    def write_updates(self):
+        for (do_id, to_id, from_id), updates in self.updates.items():
+            if len(updates) == 1:
+                field, args = updates[0]
+                dg = field.ai_format_update(do_id, to_id, from_id, args)
+            else:
+                dg = updates[0][0].dclass.ai_format_update_multiple(do_id, to_id, from_id, updates)
+            self.writer.add_datagram(dg)
+
+        self.updates.clear()
+
+    def schedule_flush(self):
+        if self.flush_handle is None:
+            self.flush_handle = self.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        if self.updates:
+            self.write_updates()
+        if self.transport is not None and len(self.writer):
+            self.transport.write(memoryview(self.writer.take()))
+
+    async def drain(self):
+        if self.lost:
+            raise ConnectionResetError('connection lost')
+
+        if self.paused:
+            waiter = asyncio.get_running_loop().create_future()
+            self.drain_waiters.append(waiter)
+            await waiter
+
+    def close(self):
+        if self.transport is not None:
+            self.flush()
+            self.transport.close()
+
+    def send_control(self, msg_type, *channels):
+        dg = Datagram()
+        dg.add_server_control_header(msg_type)
+        for channel in channels:
+            dg.add_channel(channel)
+        self.send(dg)
+
+    def subscribe_channel(self, channel):
+        self.send_control(CONTROL_SET_CHANNEL, channel)
+
+    def unsubscribe_channel(self, channel):
+        self.send_control(CONTROL_REMOVE_CHANNEL, channel)
+
+    def subscribe_range(self, low, high):
+        self.send_control(CONTROL_ADD_RANGE, low, high)
+
+    def unsubscribe_range(self, low, high):
+        self.send_control(CONTROL_REMOVE_RANGE, low, high)
+
+    def set_con_name(self, name):
+        dg = Datagram()
+        dg.add_server_control_header(CONTROL_SET_CON_NAME)
+        dg.add_string16(name.encode('utf-8'))
+        self.send(dg)
+
+    def add_post_remove(self, sender, post_dg):
+        dg = Datagram()
+        dg.add_server_control_header(CONTROL_ADD_POST_REMOVE)
+        dg.add_channel(sender)
+        dg.add_string16(post_dg.bytes())
+        self.send(dg)
+
+    def clear_post_removes(self, sender):
+        self.send_control(CONTROL_CLEAR_POST_REMOVE, sender)
+
+
+async def connect(host, port, **kwargs):
+    """Opens a connection to the message director at host:port and returns its MDProtocol."""
+    _, protocol = await asyncio.get_running_loop().create_connection(MDProtocol, host, port, **kwargs)
+    return protocol
@@ -6,9 +6,7 @@ from dataclasses import dataclass
 from dataslots import with_slots
 from typing import List
 
-from weakref import ref, WeakValueDictionary, proxy
-
-from dc.util import Datagram, DatagramIterator
+from dc.util import Datagram, DatagramIterator, FrameWriter, HashGenerator
 from dc.messagetypes import *
 from dc.error import DCParseError
 
@@ -17,6 +15,13 @@ import collections.abc
 
 import functools
 import operator
+import types
+import weakref
+
+
+# Bytes ahead of the packed values in the messages built by ai_format_update and ai_format_generate.
+UPDATE_HEADER_SIZE = 1 + 8 + 8 + 2 + 4 + 2
+GENERATE_HEADER_SIZE = 1 + 8 + 8 + 2 + 4 + 4 + 2 + 4
 
 
 class DCTypes(IntEnum):
@@ -84,6 +89,8 @@ unpack_functions = {
     DCTypes.char: DatagramIterator.get_uint8,
 }
 
+BULK_TYPES = {'int8', 'int16', 'int32', 'int64', 'uint8', 'uint16', 'uint32', 'uint64', 'float64'}
+
 fixed_byte_sizes = {
     DCTypes.int8: 1,
     DCTypes.int16: 2,
@@ -98,6 +105,23 @@ fixed_byte_sizes = {
 }
 
 
+def _total_fixed_size(packables):
+    sizes = [packable.get_fixed_size() for packable in packables]
+    return None if None in sizes else sum(sizes)
+
+
+def _size_hint(packables):
+    # The bytes known ahead of packing: fixed sizes in full, nothing for variable parts.
+    return sum(packable.get_fixed_size() or 0 for packable in packables)
+
+
+def _view_since(dgi, start, remaining=0):
+    # Rewinds to start and returns everything read since, plus the next `remaining` bytes, as one view.
+    end = dgi.tell() + remaining
+    dgi.seek(start)
+    return dgi.get_view(end - start)
+
+
 class HistoricKeywords(IntEnum):
     required = 0x0001
     broadcast = 0x0002
@@ -146,6 +170,19 @@ class DCPackable(object):
         raise NotImplementedError
 
     def unpack_bytes(self, dgi):
+        start = dgi.tell()
+        self.skip_value(dgi)
+        return _view_since(dgi, start)
+
+    def skip_value(self, dgi):
+        raise NotImplementedError
+
+    def get_fixed_size(self):
+        # The packed size in bytes, or None if it depends on the value.
+        return None
+
+    def get_default(self):
+        # The value packed when none is given: the declared default, else a zero value.
         raise NotImplementedError
 
     def generate_hash(self, hash_gen):
@@ -161,9 +198,7 @@ class Parameter(DCPackable):
         self.default = default
 
     def pack_default(self, dg):
-        if self.default is None:
-            raise DCParseError('tried packing default for parameter without default')
-        return self.pack_value(dg, self.default)
+        return self.pack_value(dg, self.get_default())
 
     def generate_hash(self, hash_gen):
         raise NotImplementedError
@@ -231,7 +266,16 @@ class SimpleParameter(Parameter):
         return unpack_functions[DCTypes[self.dtype]](dgi)
 
     def unpack_bytes(self, dgi):
-        return dgi.get_bytes(self.fixed_byte_size)
+        return dgi.get_view(self.fixed_byte_size)
+
+    def skip_value(self, dgi):
+        dgi.skip_bytes(self.fixed_byte_size)
+
+    def get_fixed_size(self):
+        return self.fixed_byte_size
+
+    def get_default(self):
+        return self.default if self.default is not None else 0
 
 
 class IntParameter(SimpleParameter):
@@ -278,11 +322,16 @@ class FloatParameter(SimpleParameter):
 
 
 class CharParameter(SimpleParameter):
-    pass
+    def get_default(self):
+        # Chars are packed as their code.
+        if isinstance(self.default, str):
+            return ord(self.default)
+
+        return SimpleParameter.get_default(self)
 
 
 class ArrayParameter(SimpleParameter):
-    __slots__ = 'arange', 'fixed_array_size', 'legacy_type'
+    __slots__ = 'arange', 'fixed_array_size', 'legacy_type', 'bulk_dtype'
 
     def __init__(self, dtype, vrange=None, modulus=None, divisor=1, identifier=None, default=None, arange=None):
         SimpleParameter.__init__(self, dtype, vrange, modulus, divisor, identifier, default)
@@ -300,6 +349,10 @@ class ArrayParameter(SimpleParameter):
 
         self.fixed_array_size = fixed_array_size
 
+        # Numeric elements are packed raw, so a run of them moves in one add_array/get_array call.
+        element_type = self.dtype.replace('array', '') if type(self.dtype) == str else None
+        self.bulk_dtype = element_type if element_type in BULK_TYPES else None
+
     def generate_hash(self, hash_gen):
         if type(self.dtype) == str:
             # Builtin type
@@ -343,6 +396,8 @@ class ArrayParameter(SimpleParameter):
             # Pack dimension
             for i in it:
                 self.pack_value(dg, i, dimension=dimension - 1)
+        elif self.bulk_dtype is not None:
+            dg.add_array(self.bulk_dtype, it)
         elif string_type:
             # TODO: fix this call
             for i in it:
@@ -405,6 +460,11 @@ class ArrayParameter(SimpleParameter):
                 subelements, sublength = self.unpack_dimension(dgi, n - 1)
                 elements.append(subelements)
                 length -= sublength
+        elif self.bulk_dtype is not None:
+            element_size = fixed_byte_sizes[DCTypes[self.bulk_dtype]]
+            if length % element_size:
+                raise DCParseError(f'array of {length} bytes does not hold a whole number of {self.bulk_dtype}')
+            elements = dgi.get_array(self.bulk_dtype, length // element_size).tolist()
         else:
             while length:
                 if string_type:
@@ -444,13 +504,47 @@ class ArrayParameter(SimpleParameter):
             n = 0
 
         if not self.fixed_array_size or not self.fixed_array_size[n]:
-            length = dgi.get_bytes(2 if not is_blob32 else 4)
-            data = dgi.get_bytes(struct.unpack('<H' if not is_blob32 else '<I', length)[0])
-            return b''.join((length, data))
+            start = dgi.tell()
+            length = dgi.get_uint16() if not is_blob32 else dgi.get_uint32()
+            return _view_since(dgi, start, length)
         else:
             length = self.fixed_array_size[n]
 
-            return dgi.get_bytes(length * self.fixed_byte_size)
+            return dgi.get_view(length * self.fixed_byte_size)
+
+    def skip_value(self, dgi):
+        size = self.get_fixed_size()
+        if size is None:
+            size = dgi.get_uint16() if self.dtype != 'blob32' else dgi.get_uint32()
+
+        dgi.skip_bytes(size)
+
+    def get_fixed_size(self):
+        n = len(self.arange) - 1 if self.arange else 0
+        if not self.fixed_array_size or not self.fixed_array_size[n]:
+            return None
+
+        return self.fixed_array_size[n] * self.fixed_byte_size
+
+    def get_default(self):
+        if self.default is not None:
+            return self.default
+
+        return self.default_dimension(len(self.arange) - 1 if self.arange else 0)
+
+    def default_dimension(self, n):
+        # Variable dimensions default to empty and fixed ones to that many zero elements.
+        size = self.fixed_array_size[n] if self.fixed_array_size else None
+        if not size:
+            return []
+
+        if n:
+            return [self.default_dimension(n - 1) for _ in range(size)]
+
+        if self.dtype in {'string', 'blob'}:
+            return [bytes(self.fixed_byte_size)] * size
+
+        return [0] * size
 
 
 class SizedParameter(SimpleParameter):
@@ -479,16 +573,29 @@ class SizedParameter(SimpleParameter):
         is_blob32 = self.dtype == 'blob32'
 
         if not self.fixed_byte_size:
-            if not is_blob32:
-                length_bytes = dgi.get_bytes(2)
-            else:
-                length_bytes = dgi.get_bytes(4)
+            start = dgi.tell()
+            length = dgi.get_uint16() if not is_blob32 else dgi.get_uint32()
+            return _view_since(dgi, start, length)
+        else:
+            return dgi.get_view(self.fixed_byte_size)
 
-            length = int.from_bytes(length_bytes, 'little')
-            data_bytes = dgi.get_bytes(length)
-            return b''.join((length_bytes, data_bytes))
+    def skip_value(self, dgi):
+        if not self.fixed_byte_size:
+            dgi.skip_bytes(dgi.get_uint16() if self.dtype != 'blob32' else dgi.get_uint32())
         else:
-            return dgi.get_bytes(self.fixed_byte_size)
+            dgi.skip_bytes(self.fixed_byte_size)
+
+    def get_fixed_size(self):
+        return self.fixed_byte_size or None
+
+    def get_default(self):
+        if self.default is not None:
+            return self.default
+
+        if self.fixed_byte_size:
+            return bytes(self.fixed_byte_size)
+
+        return '' if self.dtype == 'string' else b''
 
 
 class StructParameter(SimpleParameter):
@@ -535,9 +642,28 @@ class StructParameter(SimpleParameter):
 
         return self.dtype.unpack_bytes(dgi)
 
+    def skip_value(self, dgi):
+        # TODO: fix aliases(typedef) for base types being structs.
+        if type(self.dtype) == str:
+            return SimpleParameter.skip_value(self, dgi)
+
+        self.dtype.skip_value(dgi)
+
+    def get_fixed_size(self):
+        if type(self.dtype) == str:
+            return SimpleParameter.get_fixed_size(self)
+
+        return self.dtype.get_fixed_size()
+
+    def get_default(self):
+        if self.default is not None or type(self.dtype) == str:
+            return SimpleParameter.get_default(self)
+
+        return self.dtype.get_default()
+
 
 class DSwitch(Parameter):
-    __slots__ = 'identifier', 'parameter', 'cases', 'default_case'
+    __slots__ = 'identifier', 'parameter', 'cases', 'default_case', 'cases_by_value'
 
     def __init__(self, dtype, cases, identifier='', default_case=None, default=None):
         Parameter.__init__(self, dtype, identifier, default)
@@ -545,6 +671,18 @@ class DSwitch(Parameter):
         self.cases = cases
         self.default_case = default_case
 
+        # The first case with a given value wins, as it would in a scan of the cases.
+        self.cases_by_value = {}
+        for case in cases:
+            self.cases_by_value.setdefault(case.value, case)
+
+    def get_case(self, value):
+        case = self.cases_by_value.get(value, self.default_case)
+        if case is None:
+            raise DCParseError(f'no case for value `{value}` in switch `{self.identifier}`')
+
+        return case
+
     def validate_value(self, value):
         return True
 
@@ -578,43 +716,28 @@ class DSwitch(Parameter):
                 parameter.generate_hash(hash_gen)
 
     def pack_value(self, dg, it):
-        switched_val = it.pop(0)
-        first = self.dtype.pack_value(switched_val)
-        for case in self.cases:
-            if case.value == switched_val:
-                for item, parameter in zip(it, case.parameters):
-                    parameter.pack_value(dg, item)
-                    break
-        else:
-           for item, parameter in zip(it, self.default_case.parameters):
-               parameter.pack_value(dg, item)
+        values = tuple(it)
+        self.dtype.pack_value(dg, values[0])
+        for parameter, value in zip(self.get_case(values[0]).parameters, values[1:]):
+            parameter.pack_value(dg, value)
 
     def unpack_value(self, dgi):
         first = self.dtype.unpack_value(dgi)
+        return (first, *[parameter.unpack_value(dgi) for parameter in self.get_case(first).parameters])
 
-        for case in self.cases:
-            if case.value == first:
-                rest = [parameter.unpack_value(dgi) for parameter in case.parameters]
-                break
-        else:
-            rest = [parameter.unpack_value(dgi) for parameter in self.default_case.parameters]
+    def skip_value(self, dgi):
+        for parameter in self.get_case(self.dtype.unpack_value(dgi)).parameters:
+            parameter.skip_value(dgi)
 
-        return tuple([first] + rest)
+    def get_default(self):
+        if self.default is not None:
+            return self.default
 
-    def unpack_bytes(self, dgi):
-        curr = dgi.tell()
-        first_bytes = self.dtype.unpack_bytes(dgi)
-        dgi.seek(curr)
-        first = self.dtype.unpack_value(dgi)
-
-        for case in self.cases:
-            if case.value == first:
-                rest = [parameter.unpack_bytes(dgi) for parameter in case.parameters]
-                break
-        else:
-            rest = [parameter.unpack_bytes(dgi) for parameter in self.default_case.parameters]
+        if not self.cases:
+            raise DCParseError('switch without cases has no default')
 
-        return b''.join((first_bytes, b''.join(rest)))
+        case = self.cases[0]
+        return (case.value, *[parameter.get_default() for parameter in case.parameters])
 
 
 from typing import Any
@@ -649,7 +772,7 @@ class TypeDef(object):
 
 
 class DCField(DCPackable):
-    __slots__ = 'name', 'keywords', 'number', 'dclass', 'flags'
+    __slots__ = 'name', 'keywords', 'number', 'dclass', 'flags', 'codec', 'size_hint', 'default_blob'
 
     def __init__(self, name, keywords=()):
         self.name = name
@@ -657,6 +780,9 @@ class DCField(DCPackable):
         self.number = -1
         self.dclass = None
         self.flags = self.calc_flags()
+        self.codec = None
+        self.size_hint = None
+        self.default_blob = None
 
     @property
     def is_broadcast(self):
@@ -710,11 +836,55 @@ class DCField(DCPackable):
 
         return flags
 
+    def calc_size_hint(self):
+        return self.get_fixed_size() or 0
+
+    def get_default_blob(self):
+        """Returns the field's default value packed, encoded on first use and reused after."""
+        if self.default_blob is None:
+            dg = Datagram(reserve=self.get_size_hint())
+            self.pack_value(dg, self.get_default())
+            self.default_blob = bytes(dg)
+
+        return self.default_blob
+
+    def pack_default(self, dg):
+        dg.add_bytes(self.get_default_blob())
+
+    def get_size_hint(self):
+        """Returns how many bytes to reserve for packing this field, from the sizes known ahead of the value."""
+        if self.size_hint is None:
+            self.size_hint = self.calc_size_hint()
+
+        return self.size_hint
+
     def get_dclass(self):
         if not self.dclass:
             return None
 
-        return self.dclass()
+        return self.dclass
+
+    def compile(self, numpy_arrays=False):
+        from dc.codec import compile_field
+        self.codec = compile_field(self, numpy_arrays)
+        return self.codec
+
+    def pack_value(self, dg, value):
+        (self.codec or self.compile()).pack(dg, value)
+
+    def unpack_value(self, dgi):
+        return (self.codec or self.compile()).unpack(dgi)
+
+    def skip_value(self, dgi):
+        (self.codec or self.compile()).skip(dgi)
+
+    def get_packed_size(self, dgi):
+        """Returns the size of the value packed at the iterator's offset, leaving the offset unchanged."""
+        start = dgi.tell()
+        self.skip_value(dgi)
+        size = dgi.tell() - start
+        dgi.seek(start)
+        return size
 
     def __str__(self):
         return '%s %s %s %s' % (self.__class__.__name__, self.name, self.keywords, self.number)
@@ -723,38 +893,36 @@ class DCField(DCPackable):
         return 0
 
     def receive_update(self, obj, dgi):
-        if isinstance(self, ParameterField):
-            value = self.unpack_value(dgi)
-            setattr(obj, self.name, value)
-        else:
-            if not hasattr(obj, self.name):
-                v = self.unpack_value(dgi)
-                return
-
-            else:
-                value = self.unpack_value(dgi)
+        self.apply_update(obj, self.unpack_value(dgi))
 
-                getattr(obj, self.name)(*value)
+    def apply_update(self, obj, value):
+        method = getattr(obj, self.name, None)
+        if method is not None:
+            method(*value)
 
     def client_format_update(self, do_id, args):
         # TODO
         pass
 
     def ai_format_update(self, do_id, to_id, from_id, args):
-        dg = Datagram()
-
-        dg.add_uint8(1)
-        dg.add_channel(to_id)
-        dg.add_channel(from_id)
-        dg.add_uint16(STATESERVER_OBJECT_UPDATE_FIELD)
-        dg.add_uint32(do_id)
-        dg.add_uint16(self.number)
+        dg = Datagram(reserve=UPDATE_HEADER_SIZE + self.get_size_hint())
+        dg.add_update_header(to_id, from_id, do_id, self.number)
         self.pack_value(dg, args)
         return dg
 
+    def ai_format_update_fanout(self, do_ids, from_id, args, to_ids=None):
+        """Returns a Datagram of length-prefixed frames, one update of this field for each object in do_ids, with
+        args packed only once. The updates go to to_ids, or to the objects' own channels."""
+        dg = self.ai_format_update(0, 0, from_id, args)
+        writer = FrameWriter(reserve=len(do_ids) * (2 + len(dg)))
+        writer.add_updates(dg, do_ids, to_ids)
+        return writer.take()
+
     def ai_format_update_msg_type(self, do_id, to_id, from_id, msg_type, args):
-        # TODO
-        pass
+        dg = Datagram(reserve=UPDATE_HEADER_SIZE + self.get_size_hint())
+        dg.add_update_header(to_id, from_id, do_id, self.number, msg_type)
+        self.pack_value(dg, args)
+        return dg
 
 
 class ParameterField(DCField):
@@ -773,15 +941,18 @@ class ParameterField(DCField):
 
         self.parameter.generate_hash(hash_gen)
 
-    def pack_value(self, dg, arg):
-        self.parameter.pack_value(dg, arg)
-
-    def unpack_value(self, dgi):
-        return self.parameter.unpack_value(dgi)
-
     def unpack_bytes(self, dgi):
         return self.parameter.unpack_bytes(dgi)
 
+    def get_fixed_size(self):
+        return self.parameter.get_fixed_size()
+
+    def get_default(self):
+        return self.parameter.get_default()
+
+    def apply_update(self, obj, value):
+        setattr(obj, self.name, value)
+
     def __str__(self):
         return '%s (%s) keywords=%s, flags=%s' % (self.__class__.__name__, str(self.parameter), self.keywords, self.flags)
 
@@ -806,21 +977,14 @@ class AtomicField(DCField):
         if self.flags != ~0:
             hash_gen.add_int(self.flags)
 
-    def pack_value(self, dg, args):
-        # Allow generator usage for getters while also ensuring we pack all required parameters.
-        it = zip(self.parameters, args)
-        try:
-            for _ in range(len(self.parameters)):
-                parameter, arg = next(it)
-                parameter.pack_value(dg, arg)
-        except StopIteration:
-            raise DCParseError(f'Missing parameters for field: {self.name}. args={list(args)}')
+    def get_fixed_size(self):
+        return _total_fixed_size(self.parameters)
 
-    def unpack_value(self, dgi):
-        return tuple(parameter.unpack_value(dgi) for parameter in self.parameters)
+    def calc_size_hint(self):
+        return _size_hint(self.parameters)
 
-    def unpack_bytes(self, dgi):
-        return b''.join((parameter.unpack_bytes(dgi) for parameter in self.parameters))
+    def get_default(self):
+        return tuple(parameter.get_default() for parameter in self.parameters)
 
     def num_args(self):
         return len(self.parameters)
@@ -850,7 +1014,7 @@ class MolecularField(DCField):
         for subfield in self.subfields:
             subfield.generate_hash(hash_gen)
 
-    def pack_value(self, dg, args):
+    def pack_subfields(self, dg, args):
         n = self.num_args()
         assert len(args) == n
 
@@ -862,25 +1026,47 @@ class MolecularField(DCField):
     def num_args(self):
         return sum((subfield.num_args() for subfield in self.subfields))
 
-    def unpack_value(self, dgi):
+    def unpack_subfields(self, dgi):
         return functools.reduce(operator.iconcat, [field.unpack_value(dgi) for field in self.subfields], [])
 
-    def unpack_bytes(self, dgi):
-        return b''.join((field.unpack_bytes(dgi) for field in self.subfields))
+    def get_fixed_size(self):
+        return _total_fixed_size(self.subfields)
+
+    def calc_size_hint(self):
+        return sum(subfield.get_size_hint() for subfield in self.subfields)
+
+    def get_default(self):
+        values = []
+        for subfield in self.subfields:
+            default = subfield.get_default()
+            if isinstance(subfield, ParameterField):
+                values.append(default)
+            else:
+                values.extend(default)
+
+        return tuple(values)
 
 
 class DClass:
     def __init__(self, dcfile, name, parents, is_struct):
-        self.dcfile = dcfile  # type: ref
+        self.dcfile = dcfile  # type: DCFile
         self.name = name  # type: str
         self.fields = []  # type: List[DCField]
-        self.fields_by_index = WeakValueDictionary()
-        self.fields_by_name = WeakValueDictionary()
-        self.inherited_fields = []  # type: List[ref]
+        self.fields_by_index = {}
+        self.fields_by_name = {}
+        self.inherited_fields = []  # type: List[DCField]
         self.number = -1
         self.parents = parents  # type: List[DClass]
         self.is_struct = is_struct  # type: bool
         self.constructor = None
+        self.codec = None
+        self.required_fields = []  # type: List[DCField]
+        self.broadcast_required_fields = []  # type: List[DCField]
+        self.required_codecs = None
+        self.required_size_hint = None
+        self.required_default_blob = None
+        self.accessors = None
+        self.method_cache = weakref.WeakKeyDictionary()
 
     def __getitem__(self, item):
         if type(item) == int:
@@ -889,10 +1075,10 @@ class DClass:
             return self.fields_by_name[item]
 
     def add_field(self, field):
-        field.dclass = ref(self)
+        field.dclass = self
 
         if isinstance(field, MolecularField):
-            field.subfields = [proxy(self[name]) for name in field.subfields]
+            field.subfields = [self[name] for name in field.subfields]
             field.resolve_keywords()
 
         if field.name:
@@ -915,7 +1101,7 @@ class DClass:
 
             self.fields_by_name[field.name] = field
 
-        self.dcfile().add_field(field)
+        self.dcfile.add_field(field)
 
         if field.number in self.fields_by_index:
             raise DCParseError
@@ -950,6 +1136,14 @@ class DClass:
                 self.fields_by_name[name] = field
                 self.inherited_fields.append(field)
 
+        # Updates may arrive for inherited fields too.
+        for field in self.inherited_fields:
+            self.fields_by_index.setdefault(field.number, field)
+
+        self.required_fields = [field for field in self.inherited_fields
+                                if not isinstance(field, MolecularField) and field.is_required]
+        self.broadcast_required_fields = [field for field in self.required_fields if field.is_broadcast]
+
     def shadow_inherited_field(self, name):
         for field in self.inherited_fields:
             if field.name == name:
@@ -979,28 +1173,39 @@ class DClass:
         return 'struct {}'.format(self.name)
 
     def pack_fields_from_obj(self, dg, obj):
-        for field in self.fields:
-            self.pack_field(dg, obj, field)
+        for field, value in zip(self.fields, self.get_field_values(obj, self.fields)):
+            field.pack_value(dg, value)
 
     def receive_update(self, obj, dgi):
         field_index = dgi.get_uint16()
         field = self.fields_by_index[field_index]
-        field.receive_update(obj, dgi)
+        self.apply_update(obj, field, field.unpack_value(dgi))
+
+    def compile_required(self, numpy_arrays=False):
+        # The required fields of a generate are packed and unpacked as one block.
+        from dc.codec import compile_block
+        self.required_codecs = (compile_block(self.required_fields, numpy_arrays),
+                                compile_block(self.broadcast_required_fields, numpy_arrays))
+        return self.required_codecs
 
     def receive_update_broadcast_required(self, obj, dgi):
-        for field in self.inherited_fields:
-            if not isinstance(field, MolecularField) and field.is_required and field.is_broadcast:
-                field.receive_update(obj, dgi)
+        values = (self.required_codecs or self.compile_required())[1].unpack(dgi)
+        self.apply_updates(obj, self.broadcast_required_fields, values)
 
     def receive_update_broadcast_required_owner(self, obj, dgi):
-        for field in self.inherited_fields:
-            if not isinstance(field, MolecularField) and field.is_required:  # TODO: check if ownrecv, if not discard value
-                field.receive_update(obj, dgi)
+        # TODO: check if ownrecv, if not discard value
+        self.receive_update_all_required(obj, dgi)
 
     def receive_update_all_required(self, obj, dgi):
-        for field in self.inherited_fields:
-            if not isinstance(field, MolecularField) and field.is_required:
-                field.receive_update(obj, dgi)
+        values = (self.required_codecs or self.compile_required())[0].unpack(dgi)
+        self.apply_updates(obj, self.required_fields, values)
+
+    def skip_required_fields(self, dgi):
+        (self.required_codecs or self.compile_required())[0].skip(dgi)
+
+    def pack_required_fields(self, dg, obj):
+        values = self.get_field_values(obj, self.required_fields)
+        (self.required_codecs or self.compile_required())[0].pack(dg, values)
 
     def receive_update_other(self, obj, dgi):
         num_fields = dgi.get_uint16()
@@ -1009,7 +1214,8 @@ class DClass:
             self.receive_update(obj, dgi)
 
     def direct_update(self, obj, field_name, blob):
-        self.fields_by_name[field_name].receive_update(obj, blob)
+        field = self.fields_by_name[field_name]
+        self.apply_update(obj, field, field.unpack_value(blob))
 
     def pack_required_field(self, dg, obj, field):
         self.pack_field(dg, obj, field)
@@ -1020,8 +1226,28 @@ class DClass:
     def ai_format_update_msg_type(self, field_name, do_id, to_id, from_id, msgtype, args):
         return self.fields_by_name[field_name].ai_format_update_msg_type(do_id, to_id, from_id, msgtype, args)
 
+    def ai_format_update_multiple(self, do_id, to_id, from_id, updates):
+        """Returns one STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE message carrying each (field, args) pair of updates,
+        where field is a field name or a DCField of this class."""
+        fields = [self.fields_by_name[field] if type(field) == str else field for field, _ in updates]
+        dg = Datagram(reserve=UPDATE_HEADER_SIZE + sum(2 + field.get_size_hint() for field in fields))
+
+        # The field count takes the place of the field number in a single update's header.
+        dg.add_update_header(to_id, from_id, do_id, len(fields), STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE)
+        for field, (_, args) in zip(fields, updates):
+            dg.add_uint16(field.number)
+            field.pack_value(dg, args)
+
+        return dg
+
+    def get_required_size_hint(self):
+        if self.required_size_hint is None:
+            self.required_size_hint = sum(field.get_size_hint() for field in self.required_fields)
+
+        return self.required_size_hint
+
     def ai_format_generate(self, obj, do_id, parent_id, zone_id, district_channel_id, from_channel_id, optional_fields):
-        dg = Datagram()
+        dg = Datagram(reserve=GENERATE_HEADER_SIZE + self.get_required_size_hint())
         dg.add_uint8(1)
         dg.add_channel(district_channel_id)
         dg.add_channel(from_channel_id)
@@ -1037,9 +1263,7 @@ class DClass:
         dg.add_uint16(self.number)
         dg.add_uint32(do_id)
 
-        for field in self.inherited_fields:
-            if not isinstance(field, MolecularField) and field.is_required:
-                self.pack_field(dg, obj, field)
+        self.pack_required_fields(dg, obj)
 
         if optional_fields:
             dg.add_uint16(len(optional_fields))
@@ -1052,52 +1276,144 @@ class DClass:
         return dg
 
     def pack_field(self, dg, obj, field):
-        if isinstance(field, ParameterField):
-            try:
-                if field.name:
-                    val = getattr(obj, field.name)
-                    field.pack_value(dg, val)
-                    return
-                elif isinstance(obj, collections.abc.Sequence):
-                    val = obj[self.fields.index(field)]
-                    field.pack_value(dg, val)
-                    return
-                else:
-                    raise AttributeError
-            except AttributeError:
-                assert field.parameter.default is not None
-                field.pack_default(dg)
-                return
-        elif isinstance(field, MolecularField):
-            raise Exception
-        else:
+        field.pack_value(dg, self.get_field_value(obj, field))
 
-            if not len(field.parameters):
-                return
+    def build_accessors(self):
+        """Builds the table of how each field is read from and applied to objects, keyed by field number.
 
-            getter = field.name
+        Entries are (getter, setter, arity, position). arity is None for parameter fields, which are plain
+        attributes, and position is the field's index in self.fields for objects packed from sequences.
+        """
+        positions = {field.number: i for i, field in enumerate(self.fields)}
+        accessors = {}
 
-            if getter[:3] == 'set':
-                getter = ''.join(('get', getter[3:]))
+        for field in self.inherited_fields + self.fields:
+            name = field.name
+            position = positions.get(field.number)
 
-            try:
-                if field.name:
-                    val = getattr(obj, getter)()
+            if isinstance(field, ParameterField):
+                accessors[field.number] = name, name, None, position
+            elif isinstance(field, MolecularField):
+                accessors[field.number] = None, name, field.num_args(), position
+            else:
+                getter = 'get' + name[3:] if name[:3] == 'set' else name
+                accessors[field.number] = getter, name, len(field.parameters), position
+
+        self.accessors = accessors
+        return accessors
+
+    def get_methods(self, cls):
+        """Maps each getter and setter name to the plain function defined for it on cls, or None when there is none,
+        or it is something else such as a staticmethod or classmethod.
+
+        The functions are looked up once per class and trusted after that; call clear_method_cache after replacing
+        a getter or setter on a class that has already been packed or updated.
+        """
+        methods = self.method_cache.get(cls)
+        if methods is not None:
+            return methods
+
+        methods = {}
+        for getter, setter, arity, position in (self.accessors or self.build_accessors()).values():
+            if arity is not None:
+                for name in (getter, setter):
+                    if name:
+                        method = None
+                        for base in cls.__mro__:
+                            if name in base.__dict__:
+                                method = base.__dict__[name]
+                                break
+                        methods[name] = method if method.__class__ is types.FunctionType else None
+
+        self.method_cache[cls] = methods
+        return methods
+
+    def clear_method_cache(self, cls=None):
+        """Forgets the getters and setters looked up for cls, or for every class when cls is None."""
+        if cls is None:
+            self.method_cache.clear()
+        else:
+            self.method_cache.pop(cls, None)
+
+    def get_field_value(self, obj, field):
+        """Returns the value of field on obj, as packed by pack_field."""
+        return self.get_field_values(obj, (field,))[0]
+
+    def get_field_values(self, obj, fields):
+        accessors = self.accessors or self.build_accessors()
+        methods = self.get_methods(obj.__class__)
+        # Methods assigned on the instance take precedence, as they would for getattr.
+        instance = getattr(obj, '__dict__', ())
+        values = []
+
+        for field in fields:
+            getter, setter, arity, position = accessors[field.number]
+
+            if arity is None:
+                try:
+                    if getter:
+                        values.append(getattr(obj, getter))
+                    elif position is not None and isinstance(obj, collections.abc.Sequence):
+                        values.append(obj[position])
+                    else:
+                        raise AttributeError
+                except AttributeError:
+                    if field.parameter.default is None:
+                        raise DCParseError(f'No value or default for field: {field}, for object {obj}') from None
+                    values.append(field.get_default())
+                continue
 
-                    if len(field.parameters) == 1:
-                        val = (val, )
-                    field.pack_value(dg, val)
-                    return
+            if getter is None:
+                raise Exception
 
-                elif isinstance(obj, collections.abc.Sequence):
-                    val = obj[self.fields.index(field)]
-                    field.pack_value(dg, val)
-                    return
+            if not arity:
+                values.append(())
+                continue
+
+            method = methods[getter]
+            try:
+                if method is None or getter in instance:
+                    val = getattr(obj, getter)()
                 else:
-                    raise AttributeError
+                    val = method(obj)
             except AttributeError as e:
                 raise DCParseError(f'Could not find field: {field}, for object {obj}')
 
+            values.append((val, ) if arity == 1 else val)
+
+        return values
+
+    def apply_update(self, obj, field, value):
+        """Applies an unpacked value of field to obj, as receive_update does."""
+        self.apply_updates(obj, (field,), (value,))
+
+    def apply_updates(self, obj, fields, values):
+        accessors = self.accessors or self.build_accessors()
+        methods = self.get_methods(obj.__class__)
+        instance = getattr(obj, '__dict__', ())
+
+        for field, value in zip(fields, values):
+            getter, setter, arity, position = accessors[field.number]
+
+            if arity is None:
+                setattr(obj, setter, value)
+                continue
+
+            method = methods[setter]
+            if method is None or setter in instance:
+                method = getattr(obj, setter, None)
+                if method is not None:
+                    method(*value)
+            else:
+                method(obj, *value)
+
+    def get_required_default_blob(self):
+        """Returns the required fields' defaults packed as one block, for creating objects with default values."""
+        if self.required_default_blob is None:
+            self.required_default_blob = b''.join(field.get_default_blob() for field in self.required_fields)
+
+        return self.required_default_blob
+
     def ai_database_generate_context(self, context_id, parent_id, zone_id, owner_channel, database_server_id, from_channel_id):
         dg = Datagram()
         dg.add_uint8(1)
@@ -1109,11 +1425,7 @@ class DClass:
         dg.add_uint32(owner_channel)
         dg.add_uint16(self.number)
         dg.add_uint32(context_id)
-
-        for field in self.inherited_fields:
-            if not isinstance(field, MolecularField) and field.is_required:
-                field.pack_default(dg)
-
+        dg.add_bytes(self.get_required_default_blob())
         return dg
 
     def database_generate_context(self, obj, context_id, parent_id, zone_id, owner_channel, database_server_id, from_channel_id):
@@ -1135,8 +1447,7 @@ class DClass:
         return dg
 
     def pack_value(self, dg, obj):
-        for field in self.fields:
-            self.pack_field(dg, obj, field)
+        self.pack_fields_from_obj(dg, obj)
 
     def pack_from_iterable(self, dg, it):
         for field, value in zip(self.fields, it):
@@ -1146,4 +1457,116 @@ class DClass:
         return [field.unpack_value(dgi) for field in self.fields]
 
     def unpack_bytes(self, dgi):
-        return b''.join([field.unpack_bytes(dgi) for field in self.fields])
+        start = dgi.tell()
+        self.skip_value(dgi)
+        return _view_since(dgi, start)
+
+    def skip_value(self, dgi):
+        for field in self.fields:
+            field.skip_value(dgi)
+
+    def get_fixed_size(self):
+        return _total_fixed_size(self.fields)
+
+    def get_default(self):
+        return [field.get_default() for field in self.fields]
+
+
+class DCFile:
+    def __init__(self):
+        self.namespace = {}
+        self.classes = []  # type: List[DClass]
+        self.fields = []  # type: List[DCField]
+        self.keywords = []  # type: List[KeywordDef]
+        self.typedefs = []  # type: List[TypeDef]
+
+    def add_typedef(self, typedef):
+        self.namespace[typedef.new_type] = typedef
+        self.typedefs.append(typedef)
+
+    def add_class(self, dclass):
+        if dclass.name in self.namespace:
+            return False
+
+        self.namespace[dclass.name] = dclass
+
+        if not dclass.is_struct:
+            dclass.number = len(self.classes)
+
+        self.classes.append(dclass)
+
+    def add_keyword(self, keyword):
+        pass
+
+    def add_field(self, field):
+        field.number = len(self.fields)
+        self.fields.append(field)
+
+    def close(self):
+        """Breaks the references between classes, fields and this DCFile so the schema is freed at once.
+
+        The schema must not be used afterwards.
+        """
+        for field in self.fields:
+            field.dclass = None
+            field.codec = None
+
+        for dclass in self.classes:
+            dclass.dcfile = None
+            dclass.codec = None
+            dclass.required_codecs = None
+
+        self.namespace.clear()
+        self.classes.clear()
+        self.fields.clear()
+
+    def compile_codecs(self, numpy_arrays=False):
+        # Codecs are otherwise compiled on each field's first pack or unpack, with numeric arrays as lists.
+        for field in self.fields:
+            field.compile(numpy_arrays)
+
+        for dclass in self.classes:
+            if not dclass.is_struct:
+                dclass.compile_required(numpy_arrays)
+
+    def generate_hash(self, hash_gen):
+        hash_gen.add_int(1)
+
+        hash_gen.add_int(len(self.classes))
+
+        for dclass in self.classes:
+            dclass.generate_hash(hash_gen)
+
+    @property
+    def hash(self):
+        h = HashGenerator()
+        self.generate_hash(h)
+        return h.get_hash()
+
+    def resolve_type(self, identifier):
+        type_obj = None
+        type_info = None
+
+        while type_obj is None:
+            try:
+                if hasattr(DCTypes, identifier):
+                    type_obj = identifier
+                    break
+
+                obj = self.namespace[identifier]
+
+                if isinstance(obj, TypeDef):
+                    identifier = obj.old_type
+                    if type_info is not None and type_info[3] is not None and obj.aranges is not None:
+                        aranges = type_info[3] + obj.aranges
+                    else:
+                        aranges = obj.aranges
+
+                    type_info = (obj.ranges, obj.modulus, obj.divisor, aranges)
+                else:
+                    type_obj = obj
+
+            except KeyError:
+                raise DCParseError('unknown type', identifier)
+
+        return type_obj, type_info
@@ -2,46 +2,229 @@
 # cython: boundscheck=False
 # cython: wraparound=False
 from libc.stdlib cimport realloc, malloc, free
-from libc.string cimport memcpy
+from libc.string cimport memcmp, memcpy, memmove
+from cpython.buffer cimport PyBUF_FORMAT, PyBUF_ND, PyBUF_SIMPLE, PyBUF_STRIDES, PyBUF_WRITABLE, \
+    PyObject_CheckBuffer, PyObject_GetBuffer, PyBuffer_Release
+from cpython.memoryview cimport PyMemoryView_FromObject
+from cpython.ref cimport Py_INCREF
+from cpython.tuple cimport PyTuple_New, PyTuple_SET_ITEM
+from cpython cimport array
+cimport cython
+import array
 import numpy as np
 
+from dc.error import DCParseError
+
 
 cdef unsigned short CONTROL_MESSAGE = 4001
+cdef unsigned short STATESERVER_OBJECT_UPDATE_FIELD = 2004
+cdef char* BYTE_FORMAT = 'B'
+
+
+cdef extern from 'Python.h':
+    const char* PyUnicode_AsUTF8AndSize(object unicode, Py_ssize_t* size) except NULL
+    object PyUnicode_DecodeUTF8(const char* s, Py_ssize_t size, const char* errors)
+    object PyBytes_FromStringAndSize(const char* v, Py_ssize_t size)
+    char* PyBytes_AS_STRING(object o)
+    Py_ssize_t PyBytes_GET_SIZE(object o)
+
+
+cdef enum:
+    DEFAULT_BUFFER_SIZE = 64
+    POOL_CAPACITY = 256
+    INTERN_TABLE_SIZE = 1024
+
+# Buffers of freed datagrams are kept here and handed to new ones, so building messages in a steady loop
+# does no heap allocation once the pool is warm.
+cdef unsigned char* pool_buffers[POOL_CAPACITY]
+cdef unsigned int pool_sizes[POOL_CAPACITY]
+cdef unsigned int pool_count = 0
+cdef unsigned int pool_limit = 32
+cdef unsigned int pool_max_buffer_size = 4096
+
+
+cdef unsigned char* take_buffer(const unsigned int min_size, unsigned int* buffer_size) except NULL:
+    cdef unsigned char* buffer
+    cdef unsigned int size = DEFAULT_BUFFER_SIZE
+    global pool_count
+
+    while size < min_size and size < 0x80000000:
+        size *= 2
+
+    if size < min_size:
+        size = min_size
+
+    if pool_count:
+        pool_count -= 1
+        buffer = pool_buffers[pool_count]
+        if pool_sizes[pool_count] >= size:
+            buffer_size[0] = pool_sizes[pool_count]
+            return buffer
+        free(buffer)
+
+    buffer = <unsigned char *>malloc(size)
+    if buffer is NULL:
+        raise MemoryError('could not allocate datagram buffer of %d bytes' % size)
+
+    buffer_size[0] = size
+    return buffer
+
+
+cdef void give_buffer(unsigned char* buffer, const unsigned int buffer_size):
+    global pool_count
+
+    if pool_count < pool_limit and buffer_size <= pool_max_buffer_size:
+        pool_buffers[pool_count] = buffer
+        pool_sizes[pool_count] = buffer_size
+        pool_count += 1
+    else:
+        free(buffer)
+
+
+def set_buffer_pool(unsigned int max_buffers, unsigned int max_buffer_size=4096):
+    """Sets how many buffers of freed datagrams, of at most max_buffer_size bytes each, are kept for reuse.
+    A max_buffers of 0 turns the pool off."""
+    global pool_count, pool_limit, pool_max_buffer_size
+    cdef unsigned int i, kept = 0
+
+    if max_buffers > POOL_CAPACITY:
+        raise ValueError('the buffer pool holds at most %d buffers' % POOL_CAPACITY)
+
+    pool_limit = max_buffers
+    pool_max_buffer_size = max_buffer_size
+
+    for i in range(pool_count):
+        if kept < pool_limit and pool_sizes[i] <= pool_max_buffer_size:
+            pool_buffers[kept] = pool_buffers[i]
+            pool_sizes[kept] = pool_sizes[i]
+            kept += 1
+        else:
+            free(pool_buffers[i])
 
+    pool_count = kept
 
+
+def get_buffer_pool():
+    """Returns the number of pooled buffers, the most that are kept and their largest allowed size."""
+    return pool_count, pool_limit, pool_max_buffer_size
+
+
+# Short strings decoded from datagrams, indexed by a hash of their bytes, so that names and labels read over
+# and over are decoded once. Off unless set_string_interning is given a length.
+cdef list intern_table = [None] * INTERN_TABLE_SIZE
+cdef unsigned int intern_max_length = 0
+
+
+def set_string_interning(unsigned int max_length):
+    """Reuses decoded strings of up to max_length bytes when the same bytes are read again; 0 turns it off."""
+    global intern_max_length
+    intern_max_length = max_length
+    intern_table[:] = [None] * INTERN_TABLE_SIZE
+
+
+cdef object decode_string(const char* data, unsigned int size):
+    cdef unsigned int i, h = 2166136261
+    cdef const char* cached_data
+    cdef Py_ssize_t cached_size
+    cdef object cached
+
+    if size > intern_max_length:
+        return PyUnicode_DecodeUTF8(data, size, NULL)
+
+    for i in range(size):
+        h = (h ^ <unsigned char>data[i]) * 16777619
+    h &= INTERN_TABLE_SIZE - 1
+
+    cached = intern_table[h]
+    if cached is not None:
+        cached_data = PyUnicode_AsUTF8AndSize(cached, &cached_size)
+        if cached_size == size and memcmp(cached_data, data, size) == 0:
+            return cached
+
+    cached = PyUnicode_DecodeUTF8(data, size, NULL)
+    intern_table[h] = cached
+    return cached
+
+
+@cython.freelist(32)
 cdef class Datagram:
     cdef unsigned char* buffer
     cdef unsigned int length
     cdef unsigned int offset
     cdef unsigned int buffer_size
+    cdef Py_ssize_t exports
+    # Set while the datagram reads from another object's buffer (see wrap) rather than its own.
+    cdef bint wrapped
+    cdef Py_buffer source
 
-    def __init__(self, const unsigned char[:] initial_data=b''):
-        if initial_data.size:
-            self.append_data(&initial_data[0], initial_data.size)
+    def __init__(self, initial_data=None, unsigned int reserve=0):
+        cdef const unsigned char[:] data
 
-    def __cinit__(self):
+        if reserve > self.buffer_size:
+            give_buffer(self.buffer, self.buffer_size)
+            self.buffer = NULL
+            self.buffer = take_buffer(reserve, &self.buffer_size)
+
+        if initial_data is not None:
+            data = initial_data
+            if data.shape[0]:
+                self.append_data(&data[0], data.shape[0])
+
+    def __cinit__(self, *args, **kwargs):
+        # Subclasses may take other constructor arguments, so the reserve is handled in __init__.
         self.length = 0
         self.offset = 0
-        self.buffer_size = 64
-        self.buffer = <unsigned char *>malloc(self.buffer_size)
+        self.exports = 0
+        self.wrapped = False
+        self.buffer = take_buffer(0, &self.buffer_size)
+
+    @staticmethod
+    def wrap(data, Py_ssize_t start=0, end=None):
+        """Returns a Datagram reading directly from data[start:end] in data's buffer, without copying it.
+        The data is copied into a buffer of the datagram's own the first time it is written to."""
+        return wrap_buffer(data, start, end)
+
+    cdef int own_buffer(self, const unsigned int min_size) except -1:
+        cdef unsigned int buffer_size
+        cdef unsigned char* buffer
+
+        if self.exports:
+            raise BufferError('cannot write to a wrapped Datagram while views of it exist')
+
+        buffer = take_buffer(max(min_size, self.length), &buffer_size)
+        memcpy(buffer, self.buffer, self.length)
+        PyBuffer_Release(&self.source)
+        self.wrapped = False
+        self.buffer = buffer
+        self.buffer_size = buffer_size
+        return 0
+
+    cdef int check_resize(self, const unsigned int min_size) except -1:
+        if self.wrapped:
+            return self.own_buffer(min_size)
 
-    cdef void check_resize(self, const unsigned int min_size):
         if self.buffer_size >= min_size:
-            return
+            return 0
+
+        if self.exports:
+            # Moving the buffer would invalidate the views into it.
+            raise BufferError('cannot resize a Datagram while views of it exist')
 
         while self.buffer_size < min_size:
             self.buffer_size *= 2
 
         self.buffer = <unsigned char *>realloc(self.buffer, self.buffer_size)
+        return 0
 
-    cdef inline void append_data(self, const void* value, const unsigned int value_size):
+    cdef inline int append_data(self, const void* value, const unsigned int value_size) except -1:
         cdef unsigned int new_size = max(self.offset + value_size, self.length)
         self.check_resize(new_size)
         if self.buffer is NULL:
-            return
+            return 0
         memcpy(&self.buffer[self.offset], value, value_size)
         self.length = new_size
         self.offset += value_size
+        return 0
 
     def add_int8(self, const char value):
         self.append_data(&value, sizeof(value))
@@ -134,6 +317,24 @@ cdef class Datagram:
         self.append_data(&channel, sizeof(channel))
         self.append_data(&msg_id, sizeof(msg_id))
 
+    def add_update_header(self, unsigned long long to_id, unsigned long long from_id, unsigned int do_id,
+                          unsigned short field_number, unsigned short msg_id=STATESERVER_OBJECT_UPDATE_FIELD):
+        """Appends the server header and object id of a field update sent to to_id, up to the field number."""
+        cdef unsigned char header[25]
+        header[0] = 1
+        memcpy(&header[1], &to_id, 8)
+        memcpy(&header[9], &from_id, 8)
+        memcpy(&header[17], &msg_id, 2)
+        memcpy(&header[19], &do_id, 4)
+        memcpy(&header[23], &field_number, 2)
+        self.append_data(header, sizeof(header))
+
+    def add_array(self, dtype, values):
+        """Appends values as a run of little-endian `dtype` scalars, with no length prefix. dtype is a numeric DC
+        type name such as 'uint32'; values is an iterable of numbers or any object supporting the buffer
+        protocol, whose bytes are copied as they are unless it has a typed format."""
+        add_array_data(self, dtype, values)
+
     def add_datagram(self, Datagram dg):
         self.append_data(&dg.buffer[0], dg.length)
 
@@ -149,10 +350,39 @@ cdef class Datagram:
     def __len__(self):
         return self.length
 
+    def get_length(self):
+        return self.length
+
+    def get_message(self):
+        return memoryview(self)
+
+    def __getbuffer__(self, Py_buffer* view, int flags):
+        export_bytes(self, view, flags, self, 0, self.length)
+
+    def __releasebuffer__(self, Py_buffer* view):
+        self.exports -= 1
+
     def __dealloc__(self):
-        if self.buffer is not NULL:
-            free(self.buffer)
-            self.buffer = NULL
+        if self.wrapped:
+            PyBuffer_Release(&self.source)
+        elif self.buffer is not NULL:
+            give_buffer(self.buffer, self.buffer_size)
+        self.buffer = NULL
+
+    def reserve(self, unsigned int size):
+        """Grows the buffer to hold at least size bytes without further allocation."""
+        self.check_resize(size)
+
+    def capacity(self):
+        return self.buffer_size
+
+    def clear(self):
+        """Empties the datagram, keeping its buffer for the next message."""
+        if self.exports:
+            raise BufferError('cannot clear a Datagram while views of it exist')
+
+        self.length = 0
+        self.offset = 0
 
     def iterator(self):
         if self.buffer is NULL:
@@ -164,8 +394,7 @@ cdef class Datagram:
     def copy(self):
         if self.buffer is NULL:
             raise MemoryError('tried to make copy of invalid datagram')
-        cdef Datagram copy_dg = Datagram()
-        copy_dg.check_resize(self.length)
+        cdef Datagram copy_dg = Datagram(reserve=self.length)
         memcpy(&copy_dg.buffer[0], &self.buffer[0], self.length)
         copy_dg.length = self.length
         return copy_dg
@@ -178,6 +407,60 @@ cdef class Datagram:
     def tell(self):
         return self.offset
 
+cdef Datagram wrap_buffer(data, Py_ssize_t start, end):
+    cdef Datagram dg = Datagram.__new__(Datagram)
+    cdef Py_ssize_t stop
+
+    PyObject_GetBuffer(data, &dg.source, PyBUF_SIMPLE)
+    stop = dg.source.len if end is None else end
+    if not 0 <= start <= stop <= dg.source.len or stop - start > 0xffffffff:
+        PyBuffer_Release(&dg.source)
+        raise OverflowError('invalid range %d:%d of a buffer of %d bytes' % (start, stop, dg.source.len))
+
+    give_buffer(dg.buffer, dg.buffer_size)
+    dg.wrapped = True
+    dg.buffer = <unsigned char *>dg.source.buf + start
+    dg.length = dg.offset = dg.buffer_size = <unsigned int>(stop - start)
+    return dg
+
+
+cdef int export_bytes(Datagram dg, Py_buffer* view, int flags, owner, unsigned int start,
+                      unsigned int size) except -1:
+    if flags & PyBUF_WRITABLE:
+        raise BufferError('Datagram views are read-only')
+
+    if dg.buffer is NULL:
+        raise BufferError('tried to view invalid datagram')
+
+    view.buf = &dg.buffer[start]
+    view.obj = owner
+    view.len = size
+    view.readonly = 1
+    view.itemsize = 1
+    view.format = BYTE_FORMAT if flags & PyBUF_FORMAT else NULL
+    view.ndim = 1
+    view.shape = &view.len if flags & PyBUF_ND else NULL
+    view.strides = &view.itemsize if flags & PyBUF_STRIDES else NULL
+    view.suboffsets = NULL
+    view.internal = NULL
+    dg.exports += 1
+    return 0
+
+
+@cython.freelist(16)
+cdef class DatagramSlice:
+    # Exports part of a Datagram's buffer, so that get_view needs a single memoryview.
+    cdef Datagram dg
+    cdef unsigned int start
+    cdef unsigned int size
+
+    def __getbuffer__(self, Py_buffer* view, int flags):
+        export_bytes(self.dg, view, flags, self, self.start, self.size)
+
+    def __releasebuffer__(self, Py_buffer* view):
+        self.dg.exports -= 1
+
+
 cdef class DatagramIterator:
     cdef Datagram dg
     cdef unsigned int offset
@@ -188,6 +471,12 @@ cdef class DatagramIterator:
     cdef set_dg(self, void* ptr):
         self.dg = <Datagram> ptr
 
+    @staticmethod
+    def from_buffer(data, Py_ssize_t start=0, end=None):
+        """Returns an iterator over data[start:end], read in place from any object supporting the buffer
+        protocol. The buffer is held until the iterator is released."""
+        return iterate_buffer(data, start, end)
+
     cdef inline void get_data(self, void* value, const unsigned short num_bytes):
         cdef const unsigned char* buffer = self.dg.buffer
         memcpy(value, &buffer[self.offset], num_bytes)
@@ -273,16 +562,30 @@ cdef class DatagramIterator:
 
         return value
 
+    def get_view(self, unsigned int num_bytes):
+        """Returns a read-only memoryview of the next num_bytes without copying them.
+
+        The Datagram cannot grow past its current capacity while the view is alive.
+        """
+        if self.offset + num_bytes > self.dg.length:
+            raise OverflowError('tried reading past datagram')
+
+        cdef DatagramSlice view = DatagramSlice.__new__(DatagramSlice)
+        view.dg = self.dg
+        view.start = self.offset
+        view.size = num_bytes
+        self.offset += num_bytes
+        return PyMemoryView_FromObject(view)
+
     def get_string16(self):
         cdef unsigned short num_bytes = self.get_uint16()
 
         if self.offset + num_bytes > self.dg.length:
             raise OverflowError('tried reading past datagram')
 
-        cdef bytearray value = bytearray(num_bytes)
-        self.get_data(<unsigned char *>value, num_bytes)
-
-        return value.decode('utf-8')
+        value = decode_string(<const char *>&self.dg.buffer[self.offset], num_bytes)
+        self.offset += num_bytes
+        return value
 
     def get_blob16(self):
         cdef unsigned short num_bytes = self.get_uint16()
@@ -290,19 +593,27 @@ cdef class DatagramIterator:
         if self.offset + num_bytes > self.dg.length:
             raise OverflowError('tried reading past datagram')
 
-        cdef bytearray value = bytearray(num_bytes)
-        self.get_data(<unsigned char *>value, num_bytes)
-        return bytes(value)
+        value = PyBytes_FromStringAndSize(<const char *>&self.dg.buffer[self.offset], num_bytes)
+        self.offset += num_bytes
+        return value
 
     def get_string32(self):
         cdef unsigned int num_bytes = self.get_uint32()
         if self.offset + num_bytes > self.dg.length:
             raise OverflowError('tried reading past datagram: string length is %d' % num_bytes)
 
-        cdef bytearray value = bytearray(num_bytes)
-        self.get_data(<unsigned char *>value, num_bytes)
+        value = decode_string(<const char *>&self.dg.buffer[self.offset], num_bytes)
+        self.offset += num_bytes
+        return value
+
+    def get_blob32(self):
+        cdef unsigned int num_bytes = self.get_uint32()
+        if self.offset + num_bytes > self.dg.length:
+            raise OverflowError('tried reading past datagram: blob length is %d' % num_bytes)
 
-        return value.decode('utf-8')
+        value = PyBytes_FromStringAndSize(<const char *>&self.dg.buffer[self.offset], num_bytes)
+        self.offset += num_bytes
+        return value
 
     def seek(self, int n):
         self.offset = min(n, self.dg.length)
@@ -311,6 +622,12 @@ cdef class DatagramIterator:
         self.offset += n
         self.offset = min(self.dg.length, self.offset)
 
+    def skip_bytes(self, unsigned int n):
+        # Unlike skip, refuses to move past the end of the datagram.
+        if self.offset + n > self.dg.length:
+            raise OverflowError('tried reading past datagram')
+        self.offset += n
+
     def remaining(self):
         cdef int remaining = self.dg.length - self.offset
         if remaining < 0:
@@ -328,8 +645,685 @@ cdef class DatagramIterator:
     def tell(self):
         return self.offset
 
+    def get_remaining(self):
+        return self.get_view(self.remaining())
+
     def get_channel(self):
-        return self.get_int64()
+        return self.get_uint64()
+
+    cdef tuple read_server_header(self, bint advance):
+        cdef const unsigned char* buffer = self.dg.buffer
+        cdef unsigned int offset = self.offset
+        cdef unsigned long long channel
+        cdef unsigned short msg_type
+        cdef unsigned int i, num_targets, size
+        cdef object target
+
+        if offset + 1 > self.dg.length:
+            raise OverflowError('tried reading past datagram')
+
+        num_targets = buffer[offset]
+        size = 1 + (num_targets + 1) * sizeof(channel) + sizeof(msg_type)
+        if offset + size > self.dg.length:
+            raise OverflowError('tried reading past datagram')
+
+        targets = PyTuple_New(num_targets)
+        offset += 1
+        for i in range(num_targets):
+            memcpy(&channel, &buffer[offset], sizeof(channel))
+            offset += sizeof(channel)
+            target = channel
+            Py_INCREF(target)
+            PyTuple_SET_ITEM(targets, i, target)
+
+        memcpy(&channel, &buffer[offset], sizeof(channel))
+        memcpy(&msg_type, &buffer[offset + sizeof(channel)], sizeof(msg_type))
+
+        if advance:
+            self.offset += size
+
+        return targets, channel, msg_type
+
+    def get_array(self, dtype, unsigned int count, numpy=False):
+        """Reads count little-endian `dtype` scalars as an array.array, or with numpy=True as a read-only
+        ndarray viewing the datagram."""
+        return read_array(self, array_kind(dtype), count, numpy)
+
+    def get_server_header(self):
+        """Reads a server header, returning its (targets, sender, msg_type) with the targets as a tuple."""
+        return self.read_server_header(True)
+
+    def peek_server_header(self):
+        """Returns the server header at the current offset like get_server_header, without moving past it."""
+        return self.read_server_header(False)
+
+
+cdef DatagramIterator iterate_buffer(data, Py_ssize_t start, end):
+    cdef DatagramIterator dgi = DatagramIterator.__new__(DatagramIterator)
+    dgi.dg = wrap_buffer(data, start, end)
+    return dgi
+
+
+cdef class FrameReader:
+    """Splits a message director stream into its uint16 length-prefixed frames.
+
+    Chunks received from the stream are passed to feed, and iterating the reader then yields a
+    DatagramIterator over each complete frame, reading the frame in place."""
+    cdef Datagram storage
+    cdef unsigned int start
+
+    def __cinit__(self):
+        self.storage = Datagram()
+        self.start = 0
+
+    def feed(self, const unsigned char[:] data):
+        cdef Datagram storage = self.storage
+        cdef unsigned int size = data.shape[0]
+        cdef unsigned int pending = storage.length - self.start
+
+        if not size:
+            return
+
+        if storage.length + size > storage.buffer_size:
+            if storage.exports:
+                # Frames still read from this buffer, so the unread bytes move to a new one instead.
+                self.storage = Datagram(reserve=pending + size)
+                self.storage.append_data(&storage.buffer[self.start], pending)
+                storage = self.storage
+                self.start = 0
+            elif self.start:
+                memmove(storage.buffer, &storage.buffer[self.start], pending)
+                storage.length = storage.offset = pending
+                self.start = 0
+
+        storage.append_data(&data[0], size)
+
+    def pending(self):
+        """Returns the number of bytes received but not yet returned as frames."""
+        return self.storage.length - self.start
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        cdef Datagram storage = self.storage
+        cdef unsigned int pending = storage.length - self.start
+        cdef unsigned short size
+
+        if pending < sizeof(size):
+            raise StopIteration
+
+        memcpy(&size, &storage.buffer[self.start], sizeof(size))
+        if pending - sizeof(size) < size:
+            raise StopIteration
+
+        dgi = iterate_buffer(storage, self.start + sizeof(size), self.start + sizeof(size) + size)
+        self.start += sizeof(size) + size
+        return dgi
+
+
+cdef enum:
+    UPDATE_TO_OFFSET = 1
+    UPDATE_DO_ID_OFFSET = 19
+    UPDATE_HEADER_SIZE = 25
+
+
+cdef class FrameWriter:
+    """Batches datagrams into one buffer of uint16 length-prefixed frames, to be written to the stream at once."""
+    cdef Datagram output
+
+    def __cinit__(self, unsigned int reserve=0):
+        self.output = Datagram(reserve=reserve)
+
+    cdef int add_frame(self, Datagram dg) except -1:
+        cdef unsigned short size
+
+        if dg.length > 0xffff:
+            raise OverflowError('datagram of %d bytes is too large for a frame' % dg.length)
+
+        size = dg.length
+        self.output.append_data(&size, sizeof(size))
+        if size:
+            self.output.append_data(dg.buffer, size)
+        return 0
+
+    def add_datagram(self, Datagram dg):
+        self.add_frame(dg)
+
+    def add_datagrams(self, datagrams):
+        for dg in datagrams:
+            self.add_frame(dg)
+
+    def add_updates(self, Datagram dg, do_ids, to_ids=None):
+        """Adds a frame of the field update dg for each object id in do_ids, patching the object id and the target
+        channel into a copy of its header, so the update is packed once however many objects it goes to. The
+        targets are taken from to_ids, or are the object ids themselves."""
+        cdef unsigned int do_id, start, count = len(do_ids)
+        cdef unsigned long long to_id
+
+        if dg.length < UPDATE_HEADER_SIZE:
+            raise ValueError('datagram of %d bytes is too short for a field update' % dg.length)
+
+        if dg.buffer[0] != 1:
+            raise ValueError('field update must have exactly one target channel, not %d' % dg.buffer[0])
+
+        if to_ids is None:
+            to_ids = do_ids
+        elif len(to_ids) != count:
+            raise ValueError('expected %d targets, got %d' % (count, len(to_ids)))
+
+        self.output.check_resize(self.output.offset + count * (2 + dg.length))
+        for do_id, to_id in zip(do_ids, to_ids):
+            start = self.output.offset + 2
+            self.add_frame(dg)
+            memcpy(&self.output.buffer[start + UPDATE_TO_OFFSET], &to_id, sizeof(to_id))
+            memcpy(&self.output.buffer[start + UPDATE_DO_ID_OFFSET], &do_id, sizeof(do_id))
+
+    def __len__(self):
+        return self.output.length
+
+    def take(self):
+        """Returns the frames added so far as one Datagram, ready to be sent, and starts a new batch."""
+        cdef Datagram output = self.output
+        self.output = Datagram(reserve=output.length)
+        return output
+
+
+cdef enum:
+    KIND_INT8
+    KIND_INT16
+    KIND_INT32
+    KIND_INT64
+    KIND_UINT8
+    KIND_UINT16
+    KIND_UINT32
+    KIND_UINT64
+    KIND_FLOAT64
+    KIND_STRING
+    KIND_BLOB
+    KIND_BLOB32
+    KIND_PYTHON
+
+cdef enum:
+    MODE_VALUE
+    MODE_TUPLE
+    MODE_MOLECULAR
+    MODE_LIST
+
+# What NativeCodec's packers return when they have not packed a value, and left it untouched for Python.
+cdef enum:
+    PACKED = 0
+    UNSUPPORTED = 1
+
+cdef enum:
+    ARRAY_NONE = -1
+    ARRAY_VARIABLE = 0
+
+cdef unsigned int KIND_SIZES[9]
+KIND_SIZES[:] = [1, 2, 4, 8, 1, 2, 4, 8, 8]
+
+CODEC_KINDS = {
+    'int8': KIND_INT8,
+    'int16': KIND_INT16,
+    'int32': KIND_INT32,
+    'int64': KIND_INT64,
+    'uint8': KIND_UINT8,
+    'uint16': KIND_UINT16,
+    'uint32': KIND_UINT32,
+    'uint64': KIND_UINT64,
+    'float64': KIND_FLOAT64,
+    'string': KIND_STRING,
+    'blob': KIND_BLOB,
+    'blob32': KIND_BLOB32,
+}
+
+KIND_NAMES = ['int8', 'int16', 'int32', 'int64', 'uint8', 'uint16', 'uint32', 'uint64', 'float64']
+
+# Little-endian NumPy equivalents of the numeric kinds, for arrays given as ndarrays.
+NUMPY_DTYPES = [np.dtype(dtype).newbyteorder('<') for dtype in ('i1', 'i2', 'i4', 'i8', 'u1', 'u2', 'u4', 'u8', 'f8')]
+
+
+def ndarray_data(value, dtype):
+    """Returns the elements of the 1-D ndarray `value` as `dtype` bytes in one copy.
+
+    Integers are range checked rather than wrapped; anything else NumPy would have to truncate raises
+    TypeError, as do arrays with more than one dimension.
+    """
+    if value.ndim != 1:
+        raise TypeError('expected a 1-D array')
+
+    if value.dtype != dtype:
+        if dtype.kind in 'iu':
+            if value.dtype.kind not in 'biu':
+                raise TypeError(f'cannot pack {value.dtype} array as {dtype}')
+
+            info = np.iinfo(dtype)
+            if value.size and (value.min() < info.min or value.max() > info.max):
+                raise OverflowError(f'array value out of range for {dtype}')
+
+        elif value.dtype.kind not in 'biuf':
+            raise TypeError(f'cannot pack {value.dtype} array as {dtype}')
+
+        value = value.astype(dtype)
+
+    return value.tobytes()
+
+
+CODEC_MODES = {
+    'value': MODE_VALUE,
+    'tuple': MODE_TUPLE,
+    'molecular': MODE_MOLECULAR,
+    'list': MODE_LIST,
+}
+
+
+cdef struct CodecOp:
+    int kind
+    bint checked
+    long long divisor
+    long long array
+    Py_ssize_t index
+
+
+cdef class NativeCodec:
+    """Packs and unpacks a whole field in C.
+
+    `ops` holds one entry per parameter: either (type, divisor, checked, array, pack) for builtin types, where
+    `array` is None, 0 for a length-prefixed array or the element count of a fixed array, or a
+    (pack, unpack) pair of Python callables for anything else. Values the fast path raises for are errors, the
+    same ones the Python codec raises. Only a value it does not handle at all is passed on without having been
+    touched: a whole field that is not a tuple or list of enough values goes to pack_fallback, and an array
+    without a length or of the wrong fixed size goes to its parameter's own pack.
+    """
+    cdef CodecOp* ops
+    cdef Py_ssize_t num_ops
+    cdef int mode
+    cdef list packers
+    cdef list unpackers
+    cdef object pack_fallback
+
+    def __cinit__(self, ops, mode, pack_fallback):
+        self.num_ops = len(ops)
+        self.ops = <CodecOp *>malloc(max(self.num_ops, 1) * sizeof(CodecOp))
+        if self.ops is NULL:
+            raise MemoryError('could not allocate codec')
+
+        self.mode = CODEC_MODES[mode]
+        self.packers = []
+        self.unpackers = []
+        self.pack_fallback = pack_fallback
+
+        cdef Py_ssize_t i
+        cdef CodecOp* op
+        for i, entry in enumerate(ops):
+            op = &self.ops[i]
+            if len(entry) == 2:
+                op.kind = KIND_PYTHON
+                op.index = len(self.packers)
+                self.packers.append(entry[0])
+                self.unpackers.append(entry[1])
+                continue
+
+            dtype, divisor, checked, array, pack = entry
+            op.kind = CODEC_KINDS[dtype]
+            op.divisor = divisor
+            op.checked = checked
+            op.array = ARRAY_NONE if array is None else array
+            op.index = len(self.packers)
+            self.packers.append(pack)
+            self.unpackers.append(None)
+
+    def __dealloc__(self):
+        if self.ops is not NULL:
+            free(self.ops)
+            self.ops = NULL
+
+    def pack(self, Datagram dg, value):
+        if self.pack_all(dg, value) == UNSUPPORTED:
+            self.pack_fallback(dg, value)
+
+    def unpack(self, DatagramIterator dgi):
+        return self.unpack_all(dgi)
+
+    cdef int pack_all(self, Datagram dg, value) except -1:
+        if self.mode == MODE_VALUE:
+            return self.pack_item(dg, &self.ops[0], value)
+
+        if type(value) is not tuple and type(value) is not list:
+            return UNSUPPORTED
+
+        cdef Py_ssize_t i
+        cdef Py_ssize_t n = len(value)
+
+        if n < self.num_ops or (self.mode == MODE_MOLECULAR and n != self.num_ops):
+            # The Python codec raises its usual error for these.
+            return UNSUPPORTED
+
+        for i in range(self.num_ops):
+            self.pack_item(dg, &self.ops[i], value[i])
+
+        return PACKED
+
+    cdef int pack_item(self, Datagram dg, CodecOp* op, value) except -1:
+        if self.pack_op(dg, op, value) == UNSUPPORTED:
+            self.packers[op.index](dg, value)
+        return PACKED
+
+    cdef object unpack_all(self, DatagramIterator dgi):
+        if self.mode == MODE_VALUE:
+            return self.unpack_op(dgi, &self.ops[0])
+
+        cdef Py_ssize_t i
+        cdef list values = []
+        for i in range(self.num_ops):
+            values.append(self.unpack_op(dgi, &self.ops[i]))
+
+        if self.mode == MODE_TUPLE:
+            return tuple(values)
+
+        return values
+
+    cdef int pack_op(self, Datagram dg, CodecOp* op, value) except -1:
+        if op.kind == KIND_PYTHON:
+            self.packers[op.index](dg, value)
+            return PACKED
+
+        if op.kind >= KIND_STRING:
+            return pack_sized(dg, op.kind, value)
+
+        if op.array == ARRAY_NONE:
+            return pack_scalar(dg, op.kind, op.checked, op.divisor, value)
+
+        cdef Py_ssize_t count
+        cdef unsigned short header
+        cdef Py_buffer view
+
+        if not isinstance(value, np.ndarray) and not PyObject_CheckBuffer(value):
+            # Anything without a length, such as a generator, is left to the parameter's own packer unread.
+            try:
+                count = len(value)
+            except TypeError:
+                return UNSUPPORTED
+
+            if op.array != ARRAY_VARIABLE and count != op.array:
+                return UNSUPPORTED
+
+        data = array_buffer(op.kind, value)
+        PyObject_GetBuffer(data, &view, PyBUF_SIMPLE)
+        try:
+            if op.array == ARRAY_VARIABLE:
+                if view.len > 0xffff:
+                    raise OverflowError(f'array of {view.len} bytes is too large for a length-prefixed array')
+                header = <unsigned short>view.len
+                dg.append_data(&header, sizeof(header))
+            elif view.len != op.array * KIND_SIZES[op.kind]:
+                return UNSUPPORTED
+
+            # Array elements are packed raw: no divisor and no range check, as in ArrayParameter.
+            dg.append_data(view.buf, <unsigned int>view.len)
+        finally:
+            PyBuffer_Release(&view)
+
+        if dg.buffer is NULL:
+            raise MemoryError('could not allocate memory for datagram')
+
+        return PACKED
+
+    cdef object unpack_op(self, DatagramIterator dgi, CodecOp* op):
+        if op.kind == KIND_PYTHON:
+            return self.unpackers[op.index](dgi)
+
+        if op.kind >= KIND_STRING:
+            return unpack_sized(dgi, op.kind)
+
+        if op.array == ARRAY_NONE:
+            return unpack_scalar(dgi, op.kind, op.checked, op.divisor)
+
+        cdef unsigned int element_size = KIND_SIZES[op.kind]
+        cdef unsigned int count
+        cdef unsigned short header
+
+        if op.array == ARRAY_VARIABLE:
+            check_read(dgi, sizeof(header))
+            dgi.get_data(&header, sizeof(header))
+            if header % element_size:
+                raise DCParseError(f'array of {header} bytes does not hold a whole number of {KIND_NAMES[op.kind]}')
+            count = header // element_size
+        else:
+            count = <unsigned int>op.array
+
+        return read_array(dgi, op.kind, count, False).tolist()
+
+
+cdef inline int check_read(DatagramIterator dgi, unsigned long long num_bytes) except -1:
+    if dgi.offset + num_bytes > dgi.dg.length:
+        raise OverflowError('tried reading past datagram')
+    return 0
+
+
+# Empty arrays of the numeric kinds, cloned by get_array.
+ARRAY_TEMPLATES = [array.array(code) for code in 'bhiqBHIQd']
+assert [template.itemsize for template in ARRAY_TEMPLATES] == list(KIND_SIZES)
+
+
+cdef int array_kind(dtype) except -1:
+    kind = CODEC_KINDS.get(dtype, KIND_PYTHON)
+    if kind >= KIND_STRING:
+        raise ValueError(f'{dtype!r} is not a numeric type')
+    return kind
+
+
+cdef int add_array_data(Datagram dg, dtype, values) except -1:
+    cdef Py_buffer data
+
+    values = array_buffer(array_kind(dtype), values)
+    PyObject_GetBuffer(values, &data, PyBUF_SIMPLE)
+    try:
+        if data.len > 0xffffffff:
+            raise OverflowError('array too large for a Datagram')
+        dg.append_data(data.buf, <unsigned int>data.len)
+    finally:
+        PyBuffer_Release(&data)
+
+    return 0
+
+
+cdef object array_buffer(int kind, values):
+    # Returns an object whose buffer holds values as little-endian scalars of the kind.
+    if isinstance(values, np.ndarray):
+        values = ndarray_data(values, NUMPY_DTYPES[kind])
+    elif PyObject_CheckBuffer(values):
+        view = memoryview(values)
+        if view.itemsize != 1 or view.format not in ('B', 'b', 'c'):
+            values = ndarray_data(np.asarray(view), NUMPY_DTYPES[kind])
+        elif view.nbytes % KIND_SIZES[kind]:
+            raise ValueError(f'buffer of {view.nbytes} bytes does not hold a whole number of {KIND_NAMES[kind]}')
+    else:
+        values = array.array(ARRAY_TEMPLATES[kind].typecode, values)
+
+    return values
+
+
+cdef object read_array(DatagramIterator dgi, int kind, unsigned int count, bint numpy):
+    cdef unsigned long long size = <unsigned long long>count * KIND_SIZES[kind]
+    cdef array.array values
+
+    check_read(dgi, size)
+
+    if numpy:
+        return np.frombuffer(dgi.get_view(size), dtype=NUMPY_DTYPES[kind])
+
+    values = array.clone(ARRAY_TEMPLATES[kind], count, False)
+    if size:
+        memcpy(values.data.as_voidptr, &dgi.dg.buffer[dgi.offset], size)
+    dgi.offset += size
+    return values
+
+
+cdef int pack_scalar(Datagram dg, int kind, bint checked, long long divisor, value) except -1:
+    cdef signed char i8
+    cdef short i16
+    cdef int i32
+    cdef long long i64
+    cdef unsigned char u8
+    cdef unsigned short u16
+    cdef unsigned int u32
+    cdef unsigned long long u64
+    cdef double f64
+
+    if checked and not (type(value) is int and divisor == 1):
+        # IntParameter semantics; conversion overflow is the range check.
+        value = int(value * divisor)
+
+    try:
+        if kind == KIND_INT8:
+            i8 = value
+            dg.append_data(&i8, sizeof(i8))
+        elif kind == KIND_INT16:
+            i16 = value
+            dg.append_data(&i16, sizeof(i16))
+        elif kind == KIND_INT32:
+            i32 = value
+            dg.append_data(&i32, sizeof(i32))
+        elif kind == KIND_INT64:
+            i64 = value
+            dg.append_data(&i64, sizeof(i64))
+        elif kind == KIND_UINT8:
+            u8 = value
+            dg.append_data(&u8, sizeof(u8))
+        elif kind == KIND_UINT16:
+            u16 = value
+            dg.append_data(&u16, sizeof(u16))
+        elif kind == KIND_UINT32:
+            u32 = value
+            dg.append_data(&u32, sizeof(u32))
+        elif kind == KIND_UINT64:
+            u64 = value
+            dg.append_data(&u64, sizeof(u64))
+        else:
+            f64 = value
+            dg.append_data(&f64, sizeof(f64))
+    except OverflowError:
+        if not checked:
+            raise
+        suffix = divisor if divisor > 1 else ''
+        raise DCParseError(f'value `{value}` not in range for type `{KIND_NAMES[kind]}/{suffix}`') from None
+
+    if dg.buffer is NULL:
+        raise MemoryError('could not allocate memory for datagram')
+
+    return 0
+
+
+cdef object unpack_scalar(DatagramIterator dgi, int kind, bint checked, long long divisor):
+    cdef signed char i8
+    cdef short i16
+    cdef int i32
+    cdef long long i64
+    cdef unsigned char u8
+    cdef unsigned short u16
+    cdef unsigned int u32
+    cdef unsigned long long u64
+    cdef double f64
+
+    check_read(dgi, KIND_SIZES[kind])
+
+    if kind == KIND_FLOAT64:
+        dgi.get_data(&f64, sizeof(f64))
+        return f64
+
+    if kind == KIND_UINT64:
+        dgi.get_data(&u64, sizeof(u64))
+        if checked and divisor != 1:
+            return u64 // <unsigned long long>divisor
+        return u64
+
+    if kind == KIND_INT8:
+        dgi.get_data(&i8, sizeof(i8))
+        i64 = i8
+    elif kind == KIND_INT16:
+        dgi.get_data(&i16, sizeof(i16))
+        i64 = i16
+    elif kind == KIND_INT32:
+        dgi.get_data(&i32, sizeof(i32))
+        i64 = i32
+    elif kind == KIND_INT64:
+        dgi.get_data(&i64, sizeof(i64))
+    elif kind == KIND_UINT8:
+        dgi.get_data(&u8, sizeof(u8))
+        i64 = u8
+    elif kind == KIND_UINT16:
+        dgi.get_data(&u16, sizeof(u16))
+        i64 = u16
+    else:
+        dgi.get_data(&u32, sizeof(u32))
+        i64 = u32
+
+    if checked and divisor != 1:
+        # Without cdivision this floors, matching `value //= divisor` on Python ints.
+        return i64 // divisor
+
+    return i64
+
+
+cdef int pack_sized(Datagram dg, int kind, value) except -1:
+    cdef const char* data
+    cdef const unsigned char[:] view
+    cdef Py_ssize_t size
+    cdef unsigned short size16
+    cdef unsigned int size32
+
+    if type(value) is str:
+        data = PyUnicode_AsUTF8AndSize(value, &size)
+    elif type(value) is bytes:
+        data = PyBytes_AS_STRING(value)
+        size = PyBytes_GET_SIZE(value)
+    else:
+        view = value
+        size = view.shape[0]
+        data = <const char *>&view[0] if size else NULL
+
+    if kind == KIND_BLOB32:
+        if size > 0xffffffff:
+            raise OverflowError
+        size32 = <unsigned int>size
+        dg.append_data(&size32, sizeof(size32))
+    else:
+        if size > 0xffff:
+            raise OverflowError
+        size16 = <unsigned short>size
+        dg.append_data(&size16, sizeof(size16))
+
+    if size:
+        dg.append_data(data, <unsigned int>size)
+
+    if dg.buffer is NULL:
+        raise MemoryError('could not allocate memory for datagram')
+
+    return 0
+
+
+cdef object unpack_sized(DatagramIterator dgi, int kind):
+    cdef unsigned short size16
+    cdef unsigned int size
+
+    if kind == KIND_BLOB32:
+        check_read(dgi, sizeof(size))
+        dgi.get_data(&size, sizeof(size))
+    else:
+        check_read(dgi, sizeof(size16))
+        dgi.get_data(&size16, sizeof(size16))
+        size = size16
+
+    check_read(dgi, size)
+
+    cdef const char* data = <const char *>&dgi.dg.buffer[dgi.offset]
+    dgi.offset += size
+
+    if kind == KIND_STRING:
+        return decode_string(data, size)
+
+    return PyBytes_FromStringAndSize(data, size)
 
 
 cdef extern from 'primes.h':
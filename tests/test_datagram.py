@@ -3,9 +3,10 @@ import struct
 import random
 import array
 import os
+import socket
 
 
-from dc.util import Datagram
+from dc.util import Datagram, get_buffer_pool, set_buffer_pool
 
 
 def pack_unsigned(n):
@@ -167,6 +168,20 @@ class TestDatagram(unittest.TestCase):
         self.assertEqual(dgi.get_channel(), 10000000)
         self.assertEqual(dgi.get_uint16(), 1)
 
+    def test_update_header(self):
+        dg = Datagram()
+        dg.add_update_header(4200, 10000000, 100000, 413)
+        dg.add_update_header(4200, 5, 7, 8, 2010)
+
+        expected = Datagram()
+        expected.add_server_header([4200], 10000000, 2004)
+        expected.add_uint32(100000)
+        expected.add_uint16(413)
+        expected.add_server_header([4200], 5, 2010)
+        expected.add_uint32(7)
+        expected.add_uint16(8)
+        self.assertEqual(dg.bytes(), expected.bytes())
+
     def test_initialization(self):
         dg = Datagram(b'\x01\x02\x03')
         self.assertEqual(dg.bytes(), b'\x01\x02\x03')
@@ -176,6 +191,91 @@ class TestDatagram(unittest.TestCase):
         dg = Datagram(data)
         self.assertEqual(dg.bytes(), data)
 
+    def test_subclass(self):
+        class Named(Datagram):
+            def __init__(self, name, payload):
+                Datagram.__init__(self, payload, reserve=200)
+                self.name = name
+
+        dg = Named('x', b'\x01\x02')
+        self.assertEqual((dg.name, dg.bytes()), ('x', b'\x01\x02'))
+        self.assertGreaterEqual(dg.capacity(), 200)
+
+    def test_reserve(self):
+        dg = Datagram(reserve=1000)
+        self.assertGreaterEqual(dg.capacity(), 1000)
+
+        capacity = dg.capacity()
+        dg.add_bytes(b'x' * 1000)
+        self.assertEqual(dg.capacity(), capacity)
+
+        dg.clear()
+        self.assertEqual(len(dg), 0)
+        self.assertEqual(dg.capacity(), capacity)
+
+        dg.reserve(5000)
+        self.assertGreaterEqual(dg.capacity(), 5000)
+
+        dg.add_uint8(1)
+        view = memoryview(dg)
+        with self.assertRaises(BufferError):
+            dg.clear()
+        view.release()
+        dg.clear()
+
+    def test_wrap(self):
+        data = bytearray(b'\x01\x00\x02\x00')
+        dg = Datagram.wrap(data)
+        self.assertEqual(dg.get_length(), 4)
+
+        # The datagram reads the bytearray in place, and holds an export on it while it does.
+        data[0] = 5
+        self.assertEqual(dg.iterator().get_uint16(), 5)
+        with self.assertRaises(BufferError):
+            data.append(0)
+
+        # Writing copies the data first, releasing the bytearray.
+        dg.add_uint16(3)
+        data.append(0)
+        data[0] = 1
+        self.assertEqual(dg.bytes(), b'\x05\x00\x02\x00\x03\x00')
+
+    def test_get_message(self):
+        dg = Datagram()
+        dg.add_uint32(2525)
+        dg.add_string16(b'send')
+
+        message = dg.get_message()
+        self.assertEqual(message, dg.bytes())
+        self.assertTrue(message.readonly)
+        with self.assertRaises(BufferError):
+            dg.add_bytes(b'x' * 1000)
+        message.release()
+
+        left, right = socket.socketpair()
+        with left, right:
+            left.sendall(dg)
+            received = bytearray(len(dg))
+            right.recv_into(received)
+        self.assertEqual(Datagram.wrap(received).iterator().get_uint32(), 2525)
+
+    def test_buffer_pool(self):
+        _, limit, max_size = get_buffer_pool()
+        try:
+            set_buffer_pool(4, 256)
+            dgs = [Datagram(reserve=size) for size in (64, 128, 256, 512, 64, 64)]
+            del dgs
+            self.assertEqual(get_buffer_pool(), (4, 4, 256))
+
+            dg = Datagram(b'\x01\x02')
+            self.assertEqual(dg.bytes(), b'\x01\x02')
+            self.assertEqual(get_buffer_pool()[0], 3)
+
+            set_buffer_pool(0)
+            self.assertEqual(get_buffer_pool()[0], 0)
+        finally:
+            set_buffer_pool(limit, max_size)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,9 @@
+import array
 import unittest
 
-from dc.util import Datagram
+import numpy as np
+
+from dc.util import Datagram, DatagramIterator, set_string_interning
 
 
 class TestDatagramIterator(unittest.TestCase):
@@ -15,6 +18,128 @@ class TestDatagramIterator(unittest.TestCase):
         self.assertEqual(dgi.get_int64(), -354843598374)
         self.assertEqual(dgi.get_string32(), 'datagram iterator test')
 
+    def test_get_view(self):
+        dg = Datagram()
+        dg.add_uint16(25)
+        dg.add_bytes(b'view')
+
+        dgi = dg.iterator()
+        dgi.skip(2)
+        view = dgi.get_view(4)
+        self.assertEqual(bytes(view), b'view')
+        self.assertTrue(view.readonly)
+        self.assertEqual(dgi.tell(), 6)
+
+        with self.assertRaises(OverflowError):
+            dgi.get_view(1)
+
+        # The buffer cannot move while it is viewed.
+        with self.assertRaises(BufferError):
+            dg.add_bytes(bytes(1024))
+
+        del view
+        dg.add_bytes(bytes(1024))
+        self.assertEqual(len(dg), 1030)
+
+    def test_server_header(self):
+        dg = Datagram()
+        dg.add_server_header([4200, 2 ** 64 - 1], 10000000, 2004)
+        dg.add_uint8(7)
+
+        dgi = dg.iterator()
+        self.assertEqual(dgi.peek_server_header(), ((4200, 2 ** 64 - 1), 10000000, 2004))
+        self.assertEqual(dgi.tell(), 0)
+        self.assertEqual(dgi.get_server_header(), ((4200, 2 ** 64 - 1), 10000000, 2004))
+        self.assertEqual(dgi.get_uint8(), 7)
+
+        dgi.seek(0)
+        dgi.get_uint8()
+        self.assertEqual(dgi.get_channel(), 4200)
+        self.assertEqual(dgi.get_channel(), 2 ** 64 - 1)
+
+        dgi = Datagram(dg.bytes()[:-4]).iterator()
+        with self.assertRaises(OverflowError):
+            dgi.get_server_header()
+        self.assertEqual(dgi.tell(), 0)
+
+    def test_arrays(self):
+        dg = Datagram()
+        dg.add_array('uint32', [1, 2, 2 ** 32 - 1])
+        dg.add_array('int16', np.array([-1, 5]))
+        dg.add_array('uint16', array.array('I', [7, 8]))
+        dg.add_array('uint8', b'\x01\x02')
+
+        dgi = dg.iterator()
+        self.assertEqual(dgi.get_array('uint32', 3), array.array('I', [1, 2, 2 ** 32 - 1]))
+        values = dgi.get_array('int16', 2, numpy=True)
+        self.assertEqual(values.dtype, np.int16)
+        self.assertEqual(values.tolist(), [-1, 5])
+        self.assertEqual(dgi.get_array('uint16', 2).tolist(), [7, 8])
+        self.assertEqual(dgi.get_array('uint8', 2).tolist(), [1, 2])
+        self.assertEqual(dgi.remaining(), 0)
+
+        with self.assertRaises(OverflowError):
+            dgi.get_array('uint8', 1)
+        with self.assertRaises(OverflowError):
+            dg.add_array('uint8', [256])
+        with self.assertRaises(OverflowError):
+            dg.add_array('uint16', np.array([-1]))
+        with self.assertRaises(ValueError):
+            dg.add_array('uint32', b'\x00\x00')
+        with self.assertRaises(ValueError):
+            dg.add_array('string', [1])
+
+    def test_strings(self):
+        dg = Datagram()
+        for name in ('Flippy', 'Flippy', 'Für Elise', 'Flippy Doodle' * 10):
+            dg.add_string16(name.encode('utf-8'))
+        dg.add_string32(b'Flippy')
+        dg.add_string32(b'\x00\x01')
+
+        try:
+            set_string_interning(32)
+            dgi = dg.iterator()
+            first, second = dgi.get_string16(), dgi.get_string16()
+            self.assertEqual(first, 'Flippy')
+            self.assertIs(first, second)
+            self.assertEqual(dgi.get_string16(), 'Für Elise')
+            self.assertEqual(dgi.get_string16(), 'Flippy Doodle' * 10)
+            self.assertIs(dgi.get_string32(), first)
+            self.assertEqual(dgi.get_blob32(), b'\x00\x01')
+
+            set_string_interning(0)
+            dgi.seek(0)
+            self.assertIsNot(dgi.get_string16(), dgi.get_string16())
+        finally:
+            set_string_interning(0)
+
+    def test_from_buffer(self):
+        dg = Datagram()
+        dg.add_uint8(0xff)
+        dg.add_uint16(25)
+        dg.add_string16(b'buffer')
+        data = bytearray(dg.bytes())
+
+        dgi = DatagramIterator.from_buffer(data, 1)
+        self.assertEqual(dgi.get_uint16(), 25)
+        self.assertEqual(dgi.get_string16(), 'buffer')
+        self.assertEqual(dgi.remaining(), 0)
+
+        # The iterator holds the buffer, so it cannot be resized from under it.
+        with self.assertRaises(BufferError):
+            data.clear()
+        del dgi
+        data.append(0)
+
+        dgi = DatagramIterator.from_buffer(memoryview(data), 1, 3)
+        self.assertEqual(dgi.get_uint16(), 25)
+        with self.assertRaises(OverflowError):
+            dgi.get_uint8()
+
+        for start, end in ((4, 2), (0, len(data) + 1), (-1, None)):
+            with self.assertRaises(OverflowError):
+                DatagramIterator.from_buffer(data, start, end)
+
     def test_remaining(self):
         dg = Datagram()
         dg.add_uint16(25)
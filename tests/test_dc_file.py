@@ -1,6 +1,10 @@
+import os
+import shutil
+import tempfile
 import unittest
 
-from dc.parser import parse_dc_file, parse_dc_files, parse_dc
+from dc.cache import read_cache, read_declarations
+from dc.parser import parse_dc_file, parse_dc_files, parse_dc, load_parser
 from dc.util import Datagram
 
 SWITCH_TEST = '''
@@ -31,20 +35,127 @@ class TestDCFile(unittest.TestCase):
         dc = parse_dc_file('otp.dc')
 
         self.assertEqual(dc.hash, 1788488919)
-        self.assertEqual(dc.fields[150]().name, 'removeAvatarResponse')
+        self.assertEqual(dc.fields[150].name, 'removeAvatarResponse')
         self.assertEqual(dc.classes[23].name, 'DistributedPlayer')
 
+    def test_lookup_tables(self):
+        dc = parse_dc_files(['otp.dc', 'toon.dc'])
+
+        toon = dc.namespace['DistributedToon']
+        self.assertIs(dc.classes[toon.number], toon)
+
+        # Inherited fields can be looked up by number as well as by name.
+        set_name = toon['setName']
+        self.assertIsNot(set_name.dclass, toon)
+        self.assertIs(toon.fields_by_index[set_name.number], set_name)
+        self.assertIs(dc.fields[set_name.number], set_name)
+
+        dc.close()
+        self.assertIsNone(set_name.dclass)
+        self.assertEqual(dc.fields, [])
+
     def test_switch(self):
         dc = parse_dc(SWITCH_TEST)
 
         self.assertEqual(dc.hash, 56286)
 
-        switch = dc.fields[0]().parameter
+        switch = dc.fields[0].parameter
         self.assertEqual(len(switch.cases), 5)
         self.assertEqual(switch.default_case, None)
         self.assertEqual(switch.cases[4].value, 4)
         self.assertEqual(switch.cases[0].breaked, True)
 
+    def test_parser_reuse(self):
+        dc1 = parse_dc(SWITCH_TEST)
+        dc2 = parse_dc(SWITCH_TEST)
+        self.assertIsNot(dc1, dc2)
+        self.assertEqual(dc1.hash, dc2.hash)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            table_cache = os.path.join(tmp, 'dc_parser.cache')
+            load_parser(cache=table_cache)
+            self.assertTrue(os.path.exists(table_cache))
+
+            # The second load reads the serialized tables back.
+            load_parser(cache=table_cache)
+            self.assertEqual(parse_dc_file('otp.dc').hash, 1788488919)
+
+    def test_schema_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, 'otp.dc')
+            shutil.copy('otp.dc', source)
+            st = os.stat(source)
+            cache = os.path.join(tmp, 'otp.dcc')
+
+            self.assertIsNone(read_cache(cache, [source]))
+            dc = parse_dc_file(source, cache=cache)
+
+            cached = read_cache(cache, [source])
+            self.assertIsNotNone(cached)
+            self.assertEqual(cached.hash, dc.hash)
+            self.assertEqual(cached.fields[150].name, 'removeAvatarResponse')
+            self.assertEqual(cached.classes[23].name, 'DistributedPlayer')
+            self.assertEqual(parse_dc_file(source, cache=cache).hash, 1788488919)
+
+            # Same content under a new mtime still validates against the digest.
+            os.utime(source, ns=(0, 0))
+            self.assertIsNotNone(read_cache(cache, [source]))
+
+            # A matching size and mtime are trusted without reading the file.
+            with open(source, 'r+b') as f:
+                f.write(b'#')
+            os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns))
+            self.assertIsNotNone(read_cache(cache, [source]))
+            os.utime(source, ns=(0, 0))
+            self.assertIsNone(read_cache(cache, [source]))
+            with open(source, 'r+b') as f:
+                f.write(b'f')
+
+            with open(source, 'a') as f:
+                f.write('\ndclass CacheTest {\n  setFoo(uint8);\n};\n')
+
+            self.assertIsNone(read_cache(cache, [source]))
+            self.assertNotEqual(parse_dc_file(source, cache=cache).hash, dc.hash)
+            self.assertIsNotNone(read_cache(cache, [source]))
+
+    def test_declaration_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sources = [os.path.join(tmp, name) for name in ('otp.dc', 'toon.dc')]
+            for source in sources:
+                shutil.copy(os.path.basename(source), source)
+            cache = os.path.join(tmp, 'toon.dcc')
+
+            # The fast backend is the default once a cache is given.
+            dc = parse_dc_files(sources, cache=cache)
+            self.assertEqual(dc.hash, parse_dc_files(['otp.dc', 'toon.dc']).hash)
+            self.assertEqual(sorted(read_declarations(cache)), sorted(sources))
+
+            with open(sources[1], 'a') as f:
+                f.write('\ndclass CacheTest : DistributedObject {\n  setFoo(uint8);\n};\n')
+
+            # Only the edited file is stale; the other one keeps its cached declarations.
+            self.assertEqual(list(read_declarations(cache)), [sources[0]])
+            dc = parse_dc_files(sources, cache=cache, backend='fast')
+            self.assertEqual(dc.hash, parse_dc_files(sources).hash)
+            self.assertEqual(dc.classes[-1].name, 'CacheTest')
+
+    def test_fast_backend(self):
+        self.assertEqual(parse_dc_file('otp.dc', backend='fast').hash, 1788488919)
+        self.assertEqual(parse_dc_files(['otp.dc', 'toon.dc'], backend='fast').hash,
+                         parse_dc_files(['otp.dc', 'toon.dc']).hash)
+
+        dc = parse_dc(SWITCH_TEST, backend='fast')
+        self.assertEqual(dc.hash, 56286)
+
+        switch = dc.fields[0].parameter
+        self.assertEqual(len(switch.cases), 5)
+        self.assertEqual(switch.default_case, None)
+        self.assertEqual(switch.cases[4].value, 4)
+        self.assertEqual(switch.cases[0].breaked, True)
+
+        with self.assertRaises(ValueError):
+            parse_dc(SWITCH_TEST, backend='yacc')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,10 @@
+import gc
 import unittest
+import weakref
 
+import numpy as np
+
+from dc.error import DCParseError
 from dc.objects import AtomicField
 from dc.util import Datagram
 from dc.parser import parse_dc_file, parse_dc_files, parse_dc
@@ -13,12 +18,35 @@ dclass A {
 };'''
 
 
+TEST2_DC = '''
+struct Pos {
+    int16/10 x;
+    int16/10 y;
+    string name;
+};
+
+dclass B {
+    setA(uint32, int16/100, uint8, float64);
+    setB(Pos, Pos [], int16 [2]);
+    setC(uint8);
+    setD(int8);
+    setCD : setC, setD;
+};
+
+dclass C : B {
+    setE(uint16 [], uint32) required broadcast;
+    uint16/10 f required;
+    setG(int8, int8) required broadcast;
+    setH(uint8) broadcast;
+};'''
+
+
 class TestDCPacker(unittest.TestCase):
     def test_legacy_arrays(self):
         dc = parse_dc(TEST1_DC)
-        field = dc.fields[0]()  # type: AtomicField
-        field2 = dc.fields[1]()  # type: AtomicField
-        field3 = dc.fields[2]()  # type: AtomicField
+        field = dc.fields[0]  # type: AtomicField
+        field2 = dc.fields[1]  # type: AtomicField
+        field3 = dc.fields[2]  # type: AtomicField
 
         arg1 = [2, 4, 8, 16, 32]
         dg = Datagram()
@@ -39,6 +67,287 @@ class TestDCPacker(unittest.TestCase):
 
         self.assertEqual(field3.unpack_value(dg3.iterator())[0], [[1, 2], [3, 4], [5, 6]])
 
+    def test_compiled_codecs(self):
+        dc = parse_dc(TEST2_DC)
+        dc.compile_codecs()
+        set_a, set_b, set_cd = (dc.namespace['B'][name] for name in ('setA', 'setB', 'setCD'))
+
+        args = (7, 1.25, 255, 0.5)
+        dg = Datagram()
+        set_a.pack_value(dg, args)
+        expected = Datagram()
+        for parameter, arg in zip(set_a.parameters, args):
+            parameter.pack_value(expected, arg)
+        self.assertEqual(dg.bytes(), expected.bytes())
+        self.assertEqual(set_a.unpack_value(dg.iterator()), (7, 1, 255, 0.5))
+
+        with self.assertRaises(DCParseError):
+            set_a.pack_value(Datagram(), (7, 1.25, 256, 0.5))
+
+        with self.assertRaises(DCParseError):
+            set_a.pack_value(Datagram(), (7, 1.25))
+
+        with self.assertRaises(OverflowError):
+            set_a.unpack_value(Datagram(dg.bytes()[:-1]).iterator())
+
+        dg = Datagram()
+        set_b.pack_value(dg, ([1, 2, 'a'], [[3, 4, 'b']], [5, -6]))
+        self.assertEqual(set_b.unpack_value(dg.iterator()), ([1, 2, 'a'], [[3, 4, 'b']], [5, -6]))
+
+        # An error raised for a later value is not retried through the Python codec, which would iterate the
+        # earlier values again.
+        class Positions:
+            iterations = 0
+
+            def __iter__(self):
+                Positions.iterations += 1
+                return iter([[3, 4, 'b']])
+
+        with self.assertRaises(OverflowError):
+            set_b.pack_value(Datagram(), ([1, 2, 'a'], Positions(), [5, 70000]))
+        self.assertEqual(Positions.iterations, 1)
+
+        # A fixed array of the wrong size goes to the array's own packer alone.
+        dg = Datagram()
+        set_b.pack_value(dg, ([1, 2, 'a'], (pos for pos in [[3, 4, 'b']]), [5, -6, 7]))
+        expected = Datagram()
+        set_b.pack_value(expected, ([1, 2, 'a'], [[3, 4, 'b']], [5, -6]))
+        expected.add_int16(7)
+        self.assertEqual(dg.bytes(), expected.bytes())
+
+        dg = Datagram()
+        set_cd.pack_value(dg, (1, -1))
+        self.assertEqual(dg.bytes(), b'\x01\xff')
+        self.assertEqual(set_cd.unpack_value(dg.iterator()), [1, -1])
+
+    def test_required_block(self):
+        dc = parse_dc(TEST2_DC)
+        dclass = dc.namespace['C']
+
+        self.assertEqual([field.name for field in dclass.required_fields], ['setE', 'f', 'setG'])
+        self.assertEqual([field.name for field in dclass.broadcast_required_fields], ['setE', 'setG'])
+
+        class Obj:
+            f = 1.5
+
+            def getE(self):
+                return [1, 2], 3
+
+            def getG(self):
+                return -1, 1
+
+        dg = Datagram()
+        dclass.pack_required_fields(dg, Obj())
+
+        expected = Datagram()
+        for field, args in zip(dclass.required_fields, (([1, 2], 3), 1.5, (-1, 1))):
+            field.pack_value(expected, args)
+        self.assertEqual(dg.bytes(), expected.bytes())
+
+        updates = []
+
+        class Receiver:
+            def setE(self, *args):
+                updates.append(args)
+
+            def setG(self, *args):
+                updates.append(args)
+
+        receiver = Receiver()
+        dclass.receive_update_all_required(receiver, dg.iterator())
+        self.assertEqual(updates, [([1, 2], 3), (-1, 1)])
+        self.assertEqual(receiver.f, 1)
+
+    def test_accessors(self):
+        dc = parse_dc(TEST2_DC)
+        dclass = dc.namespace['C']
+
+        self.assertEqual(dclass.build_accessors()[dclass['setG'].number], ('getG', 'setG', 2, 2))
+        self.assertEqual(dclass.accessors[dclass['f'].number], ('f', 'f', None, 1))
+
+        class Obj:
+            f = 2.5
+
+            def getG(self):
+                return 1, 2
+
+            def setG(self, *args):
+                self.g = args
+
+        obj = Obj()
+        self.assertEqual(dclass.get_field_values(obj, [dclass['f'], dclass['setG']]), [2.5, (1, 2)])
+
+        # Methods set on the instance shadow the class's.
+        obj.getG = lambda: (3, 4)
+        self.assertEqual(dclass.get_field_value(obj, dclass['setG']), (3, 4))
+
+        dclass.apply_updates(obj, [dclass['f'], dclass['setG']], [4, (5, 6)])
+        self.assertEqual((obj.f, obj.g), (4, (5, 6)))
+
+        class Static:
+            f = 0
+
+            @staticmethod
+            def getG():
+                return 7, 8
+
+        self.assertEqual(dclass.get_field_value(Static(), dclass['setG']), (7, 8))
+
+        # Methods replaced on the class after its methods were cached are picked up once the cache is cleared.
+        Obj.getG = lambda self: (9, 10)
+        dclass.clear_method_cache(Obj)
+        self.assertEqual(dclass.get_field_value(Obj(), dclass['setG']), (9, 10))
+
+        # The cached methods do not keep the class alive.
+        static = weakref.ref(Static)
+        self.assertIn(Static, dclass.method_cache)
+        del Static
+        gc.collect()
+        self.assertIsNone(static())
+
+    def test_numpy_arrays(self):
+        dc = parse_dc(TEST1_DC)
+        dclass = dc.namespace['A']
+
+        for name in ('fieldTest1', 'fieldTest2'):
+            field = dclass[name]
+
+            dg = Datagram()
+            field.pack_value(dg, (np.arange(300, 310, dtype=np.int64) - 300,))
+            expected = Datagram()
+            field.pack_value(expected, (list(range(10)),))
+            self.assertEqual(dg.bytes(), expected.bytes())
+
+            with self.assertRaises(OverflowError):
+                field.pack_value(Datagram(), (np.array([256]),))
+
+            field.compile(numpy_arrays=True)
+            value, = field.unpack_value(dg.iterator())
+            self.assertIsInstance(value, np.ndarray)
+            self.assertEqual(value.dtype, np.uint8)
+            self.assertEqual(value.tolist(), list(range(10)))
+            self.assertTrue(np.shares_memory(value, np.frombuffer(dg.get_message(), np.uint8)))
+
+    def test_unpack_bytes(self):
+        dc = parse_dc(TEST2_DC)
+        dclass = dc.namespace['B']
+
+        for name, args in (('setCD', (1, -1)), ('setB', ([1, 2, 'a'], [[3, 4, 'b']], [5, -6]))):
+            field = dclass[name]
+            dg = Datagram()
+            field.pack_value(dg, args)
+            data = dg.bytes()
+            dg.add_uint8(0)
+
+            dgi = dg.iterator()
+            view = field.unpack_bytes(dgi)
+            self.assertIsInstance(view, memoryview)
+            self.assertEqual(view, data)
+            self.assertEqual(dgi.tell(), len(data))
+
+    def test_skip_value(self):
+        dc = parse_dc(TEST2_DC)
+        dclass = dc.namespace['C']
+
+        self.assertEqual(dclass['setA'].get_fixed_size(), 15)
+        self.assertEqual(dclass['setCD'].get_fixed_size(), 2)
+        self.assertIsNone(dclass['setB'].get_fixed_size())
+
+        dg = Datagram()
+        dclass['setB'].pack_value(dg, ([1, 2, 'a'], [[3, 4, 'bc']], [5, -6]))
+        dclass['setA'].pack_value(dg, (7, 1.25, 255, 0.5))
+        dclass['setE'].pack_value(dg, ([1, 2, 3], 4))
+
+        dgi = dg.iterator()
+        self.assertEqual(dclass['setB'].get_packed_size(dgi), 21)
+        self.assertEqual(dgi.tell(), 0)
+        dclass['setB'].skip_value(dgi)
+        dclass['setA'].skip_value(dgi)
+        self.assertEqual(dclass['setE'].unpack_value(dgi), ([1, 2, 3], 4))
+
+        dg = Datagram()
+        dclass['setA'].pack_value(dg, (7, 1.25, 255, 0.5))
+        with self.assertRaises(OverflowError):
+            dclass['setA'].skip_value(Datagram(dg.bytes()[:-1]).iterator())
+
+    def test_default_blobs(self):
+        source = '''
+struct Pos {
+    int16/10 x = 5;
+    int16 y;
+    string name = "bob";
+};
+
+dclass D {
+    setA(uint32 a = 7, int8 b = -3, char c = 'x') required;
+    setArr(uint16 v[] = {1, 2, 3}, uint8 f[3]) required;
+    setPos(Pos) required;
+    setName(string) required;
+    setFlag() required;
+    uint16 hp = 100 required;
+    char grade = 'b' required;
+    setOther(uint8) broadcast;
+};'''
+
+        for backend in ('lark', 'fast'):
+            dclass = parse_dc(source, backend=backend).namespace['D']
+            defaults = [field.get_default() for field in dclass.required_fields]
+            self.assertEqual(defaults, [(7, -3, ord('x')), ([1, 2, 3], [0, 0, 0]), ([5, 0, 'bob'],), ('',), (), 100,
+                                        ord('b')])
+            self.assertEqual(dclass['setFlag'].get_default_blob(), b'')
+
+            expected = Datagram()
+            for field, value in zip(dclass.required_fields, defaults):
+                field.pack_value(expected, value)
+            self.assertEqual(dclass.get_required_default_blob(), expected.bytes())
+            self.assertIs(dclass['hp'].get_default_blob(), dclass['hp'].get_default_blob())
+
+            dg = dclass.ai_database_generate_context(1, 2, 3, 4, 5, 6)
+            self.assertEqual(dg.bytes()[-len(expected):], expected.bytes())
+
+            # Parameter fields missing from an object fall back to their declared default, and only to that.
+            class Obj:
+                grade = 'c'
+
+            self.assertEqual(dclass.get_field_values(Obj(), [dclass['hp'], dclass['grade']]), [100, 'c'])
+            del Obj.grade
+            self.assertEqual(dclass.get_field_value(Obj(), dclass['grade']), ord('b'))
+
+        dclass = parse_dc('dclass E { uint16 hp required; };').namespace['E']
+        with self.assertRaises(DCParseError):
+            dclass.get_field_value(object(), dclass['hp'])
+
+    def test_switch_cases(self):
+        dc = parse_dc('''
+struct Effect {
+  switch (uint8) {
+  case 1:
+  case 2:
+    uint16 amount;
+    break;
+  case 3:
+    int8 x;
+    int8 y;
+    break;
+  default:
+    uint32 duration;
+    break;
+  };
+};''')
+        switch = dc.namespace['Effect'].fields[0].parameter
+        self.assertIs(switch.get_case(2).parameters, switch.get_case(1).parameters)
+        self.assertIs(switch.get_case(9), switch.default_case)
+
+        for value in ((1, 500), (2, 7), (3, -1, 1), (9, 100000)):
+            dg = Datagram()
+            switch.pack_value(dg, value)
+            self.assertEqual(switch.unpack_value(dg.iterator()), value)
+
+            compiled = Datagram()
+            dc.namespace['Effect'].fields[0].pack_value(compiled, value)
+            self.assertEqual(compiled.bytes(), dg.bytes())
+            self.assertEqual(dc.namespace['Effect'].fields[0].unpack_value(dg.iterator()), value)
+
 
 if __name__ == '__main__':
     unittest.main()
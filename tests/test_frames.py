@@ -0,0 +1,96 @@
+import unittest
+
+from dc.parser import parse_dc
+from dc.util import Datagram, FrameReader, FrameWriter
+
+
+def make_datagram(n):
+    dg = Datagram()
+    dg.add_uint32(n)
+    dg.add_string16(b'x' * (n % 7))
+    return dg
+
+
+def read_frame(dgi):
+    if not dgi.remaining():
+        return None
+
+    value = dgi.get_uint32(), dgi.get_string16()
+    assert not dgi.remaining()
+    return value
+
+
+class TestFrames(unittest.TestCase):
+    def test_round_trip(self):
+        writer = FrameWriter()
+        writer.add_datagram(Datagram())
+        writer.add_datagrams(make_datagram(n) for n in range(100))
+        data = writer.take().bytes()
+        self.assertEqual(len(writer), 0)
+
+        # Split the stream into chunks of varying size, either holding every frame read, so the reader cannot
+        # move its buffer, or reading each frame as it comes.
+        for chunk_size in (1, 2, 3, 50, len(data)):
+            for hold in (True, False):
+                reader = FrameReader()
+                frames = []
+                values = []
+                for i in range(0, len(data), chunk_size):
+                    reader.feed(data[i:i + chunk_size])
+                    for dgi in reader:
+                        if hold:
+                            frames.append(dgi)
+                        else:
+                            values.append(read_frame(dgi))
+
+                self.assertEqual(reader.pending(), 0)
+                values += [read_frame(dgi) for dgi in frames]
+                self.assertEqual(values, [None] + [(n, 'x' * (n % 7)) for n in range(100)])
+
+    def test_partial_frame(self):
+        reader = FrameReader()
+        reader.feed(b'\x04\x00\x01\x02')
+        self.assertEqual(list(reader), [])
+        self.assertEqual(reader.pending(), 4)
+
+        reader.feed(b'\x03\x00\x05')
+        dgi, = reader
+        self.assertEqual(dgi.get_uint32(), 0x00030201)
+        self.assertEqual(reader.pending(), 1)
+
+    def test_frame_too_large(self):
+        dg = Datagram()
+        dg.add_bytes(bytes(0x10000))
+        with self.assertRaises(OverflowError):
+            FrameWriter().add_datagram(dg)
+
+    def test_update_fanout(self):
+        field = parse_dc('dclass A { setState(string, int16) broadcast; };').namespace['A']['setState']
+        do_ids = [100000 + n for n in range(50)]
+
+        expected = FrameWriter()
+        expected.add_datagrams(field.ai_format_update(do_id, do_id, 4000, ('walk', -5)) for do_id in do_ids)
+        self.assertEqual(field.ai_format_update_fanout(do_ids, 4000, ('walk', -5)).bytes(), expected.take().bytes())
+
+        to_ids = [2 ** 40 + do_id for do_id in do_ids]
+        expected.add_datagrams(field.ai_format_update(do_id, to_id, 4000, ('walk', -5))
+                               for do_id, to_id in zip(do_ids, to_ids))
+        self.assertEqual(field.ai_format_update_fanout(do_ids, 4000, ('walk', -5), to_ids).bytes(),
+                         expected.take().bytes())
+
+        with self.assertRaises(ValueError):
+            field.ai_format_update_fanout(do_ids, 4000, ('walk', -5), to_ids[1:])
+
+        with self.assertRaises(ValueError):
+            FrameWriter().add_updates(make_datagram(1), do_ids)
+
+        dg = Datagram()
+        dg.add_server_header([100000, 100001], 4000, 2004)
+        dg.add_uint32(100000)
+        dg.add_uint16(field.number)
+        with self.assertRaises(ValueError):
+            FrameWriter().add_updates(dg, do_ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
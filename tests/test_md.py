@@ -0,0 +1,156 @@
+import asyncio
+import unittest
+
+from dc.md import connect
+from dc.messagetypes import CONTROL_MESSAGE, STATESERVER_OBJECT_DELETE_RAM, STATESERVER_OBJECT_UPDATE_FIELD, \
+    STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE
+from dc.parser import parse_dc
+from dc.util import Datagram
+
+
+UPDATES_DC = '''
+dclass Avatar {
+    setHp(int16) broadcast;
+    setPos(int16, int16) broadcast;
+    setName(string) broadcast;
+};'''
+
+
+async def echo(reader, writer):
+    while data := await reader.read(4096):
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+class TestMDProtocol(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = await asyncio.start_server(echo, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def test_echo(self):
+        md = await connect('127.0.0.1', self.port)
+        md.subscribe_channel(4000)
+
+        for n in range(500):
+            dg = Datagram()
+            dg.add_server_header([1000 + n, 2000], 4000, STATESERVER_OBJECT_UPDATE_FIELD)
+            dg.add_uint32(n)
+            md.send(dg)
+
+        # Every datagram sent in this iteration of the loop goes out in one write.
+        self.assertIsNotNone(md.flush_handle)
+        self.assertEqual(len(md.writer), (2 + 19) + 500 * (2 + 31))
+
+        received = []
+        async for targets, sender, msg_type, dgi in md:
+            received.append((targets, sender, msg_type, dgi))
+            if len(received) == 501:
+                md.close()
+
+        # The echoed control message is only checked for its target, as the rest is not a server header.
+        self.assertEqual(received[0][0], (CONTROL_MESSAGE,))
+        self.assertEqual([(targets, sender, msg_type, dgi.get_uint32())
+                          for targets, sender, msg_type, dgi in received[1:]],
+                         [((1000 + n, 2000), 4000, STATESERVER_OBJECT_UPDATE_FIELD, n) for n in range(500)])
+
+    async def test_update_batching(self):
+        dclass = parse_dc(UPDATES_DC).namespace['Avatar']
+        md = await connect('127.0.0.1', self.port)
+        md.subscribe_channel(4000)
+
+        md.update_field(1000, 1000, 4000, dclass['setHp'], (15,))
+        md.update_field(1000, 1000, 4000, dclass['setPos'], (3, -4))
+        md.update_field(1001, 1001, 4000, dclass['setName'], ('bob',))
+        md.update_field(1000, 1000, 4000, dclass['setHp'], (14,))
+
+        class Receiver:
+            def __init__(self):
+                self.calls = []
+
+            def __getattr__(self, name):
+                return lambda *args: self.calls.append((name, args))
+
+        received = []
+        async for targets, sender, msg_type, dgi in md:
+            if targets == (CONTROL_MESSAGE,):
+                continue
+
+            receiver = Receiver()
+            do_id = dgi.get_uint32()
+            if msg_type == STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE:
+                dclass.receive_update_other(receiver, dgi)
+            else:
+                dclass.receive_update(receiver, dgi)
+            received.append((targets, sender, msg_type, do_id, receiver.calls))
+
+            if len(received) == 2:
+                md.close()
+
+        self.assertEqual(received, [
+            ((1000,), 4000, STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE, 1000,
+             [('setHp', (15,)), ('setPos', (3, -4)), ('setHp', (14,))]),
+            ((1001,), 4000, STATESERVER_OBJECT_UPDATE_FIELD, 1001, [('setName', ('bob',))]),
+        ])
+
+    async def test_drain(self):
+        md = await connect('127.0.0.1', self.port)
+        md.pause_writing()
+        drains = [asyncio.ensure_future(md.drain()) for _ in range(2)]
+        await asyncio.sleep(0)
+        self.assertFalse(any(drain.done() for drain in drains))
+
+        md.resume_writing()
+        await asyncio.gather(*drains)
+        md.close()
+        await asyncio.sleep(0)
+
+        with self.assertRaises(ConnectionResetError):
+            await md.drain()
+
+    async def test_update_order(self):
+        dclass = parse_dc(UPDATES_DC).namespace['Avatar']
+        md = await connect('127.0.0.1', self.port)
+
+        md.update_field(1000, 1000, 4000, dclass['setHp'], (15,))
+        md.update_field(1000, 1000, 4000, dclass['setPos'], (3, -4))
+        dg = Datagram()
+        dg.add_server_header([1000], 4000, STATESERVER_OBJECT_DELETE_RAM)
+        dg.add_uint32(1000)
+        md.send(dg)
+        md.update_field(1000, 1000, 4000, dclass['setHp'], (14,))
+        md.update_field_fanout([1000], 4000, dclass['setName'], ('bob',))
+
+        received = []
+        async for targets, sender, msg_type, dgi in md:
+            received.append(msg_type)
+            if len(received) == 4:
+                md.close()
+
+        self.assertEqual(received, [STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE, STATESERVER_OBJECT_DELETE_RAM,
+                                    STATESERVER_OBJECT_UPDATE_FIELD, STATESERVER_OBJECT_UPDATE_FIELD])
+
+    async def test_malformed_datagram(self):
+        md = await connect('127.0.0.1', self.port)
+
+        dg = Datagram()
+        dg.add_server_header([1000], 4000, STATESERVER_OBJECT_UPDATE_FIELD)
+        md.send(dg)
+        md.send(Datagram(b'\x01\x02\x03'))
+        md.send(dg)
+
+        received = []
+        with self.assertRaises(OverflowError):
+            async for targets, sender, msg_type, dgi in md:
+                received.append((targets, sender, msg_type))
+
+        self.assertEqual(received, [((1000,), 4000, STATESERVER_OBJECT_UPDATE_FIELD)])
+        self.assertTrue(md.transport.is_closing())
+
+
+if __name__ == '__main__':
+    unittest.main()